@@ -1,12 +1,35 @@
 import os
+import io
+import re
+import csv
+import sys
+import copy
+import time
+import queue
+import atexit
+import logging
+import functools
+import threading
+import contextlib
+import logging.handlers
+import random
+import asyncio
 import sqlite3
 import json
 import base64
+import hashlib
+import heapq
+import secrets
+import unicodedata
+from collections import Counter, deque
+from contextvars import ContextVar
 from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
 import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 # Load environment variables
 load_dotenv()
@@ -19,19 +42,364 @@ app = FastAPI()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# Shared secret for the /admin/* HTTP endpoints, sent as the X-Admin-Token header only
+# (query strings end up in access logs)
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+# Calendar apps cannot send headers, so the read-only feed has its own URL secret:
+# /admin/calendar/<CALENDAR_FEED_TOKEN>.ics. Rotate it on its own if the URL leaks.
+CALENDAR_FEED_TOKEN = os.getenv("CALENDAR_FEED_TOKEN")
 TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 DB_NAME = "dental_bot.db"
 
 # Dubai timezone (UTC+4)
 DUBAI_TZ = timezone(timedelta(hours=4))
 
+# Gemini models: the secondary is used for hedged requests and as a fallback
+GEMINI_PRIMARY_MODEL = os.getenv("GEMINI_PRIMARY_MODEL", "gemini-1.5-flash")
+GEMINI_SECONDARY_MODEL = os.getenv("GEMINI_SECONDARY_MODEL", "gemini-1.5-flash-8b")
+GEMINI_TIMEOUT = 20  # seconds, per HTTP attempt
+GEMINI_DEADLINE = 25  # seconds, whole call: both models, all retries and backoff
+GEMINI_MAX_ATTEMPTS = 3  # per model, retried on 429/5xx/transport errors
+GEMINI_BACKOFF_BASE = 0.5  # seconds, full-jitter exponential backoff
+# Hedge after the observed p95 latency, clamped to this window (seconds)
+GEMINI_HEDGE_MIN = 2.0
+GEMINI_HEDGE_MAX = 15.0
+# Circuit breaker: open after N consecutive failed calls, probe again after cooldown
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 30  # seconds
+
+# Reminders go out this long before each appointment, e.g. "24h,2h" or "90m"
+REMINDER_OFFSETS = os.getenv("REMINDER_OFFSETS", "24h,2h")
+# Upper bound on one scheduler sleep; only guards against wall-clock jumps
+REMINDER_MAX_SLEEP = 3600
+
+# Length of one appointment, used for calendar export
+SLOT_DURATION = timedelta(hours=1)
+# Rows fetched per round-trip when streaming exports
+EXPORT_CHUNK_SIZE = 500
+# Bulk patient import: rows per transaction, and country code for local numbers ("050...")
+IMPORT_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS_REPORTED = 20
+DEFAULT_COUNTRY_CODE = os.getenv("DEFAULT_COUNTRY_CODE", "971")
+PHONE_MIN_NATIONAL_DIGITS = 7  # shorter local numbers are junk, not something to prefix
+
+# Logging: level, share of routine per-update lines kept, per-event lines/second cap
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_UPDATE_SAMPLE_RATE = float(os.getenv("LOG_UPDATE_SAMPLE_RATE", "1.0"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_SLOW_UPDATE_MS = 2000  # slower updates are always logged, regardless of sampling and rate limits
+# Optional OTLP/JSON trace file (one ExportTraceServiceRequest per line)
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+PROFILE_MAX_SECONDS = 60
+
 # Google Maps Link (Search query based on address)
 MAP_LINK = "https://www.google.com/maps/search/?api=1&query=Gemini+Medical+Center+Dubai+Al+Wasl+Rd+Al+Safa+1"
 
+# -----------------------------------------
+# LOGGING (JSON lines, written off the request path)
+# -----------------------------------------
+# Per-update context (chat_id, update_id, branch), attached to every line logged while handling it
+LOG_CTX = ContextVar("log_ctx", default=None)
+# Very short values would match ordinary text; those are left to the patterns below
+LOG_SECRETS = [
+    v for v in (TELEGRAM_TOKEN, GOOGLE_API_KEY, ADMIN_API_TOKEN, CALENDAR_FEED_TOKEN) if v and len(v) >= 8
+]
+LOG_REDACT_PATTERNS = [
+    (re.compile(r"bot\d+:[A-Za-z0-9_-]+"), "bot<redacted>"),
+    (re.compile(r"((?:key|token)=)[^&\s\"']+", re.IGNORECASE), r"\1<redacted>"),
+]
+
+
+def redact(text):
+    for secret in LOG_SECRETS:
+        text = text.replace(secret, "<redacted>")
+    for pattern, repl in LOG_REDACT_PATTERNS:
+        text = pattern.sub(repl, text)
+    return text
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the caller's task: snapshot the context and apply sampling / rate limits
+    # before anything is enqueued, so dropped lines cost almost nothing.
+    def __init__(self):
+        super().__init__()
+        self.buckets = {}  # event -> [tokens, last_refill, suppressed]
+
+    def filter(self, record):
+        # Errors and lines flagged keep=True (slow updates) bypass sampling and rate limits
+        if record.levelno < logging.ERROR and not getattr(record, "keep", False):
+            if not self.admit(record):
+                return False
+        record.ctx = dict(LOG_CTX.get() or {})
+        return True
+
+    def admit(self, record):
+        sample = getattr(record, "sample", 1.0)
+        if sample < 1.0 and random.random() >= sample:
+            return False
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(record.msg, [LOG_RATE_LIMIT, now, 0])
+        bucket[0] = min(LOG_RATE_LIMIT, bucket[0] + (now - bucket[1]) * LOG_RATE_LIMIT)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting and redaction happen in the listener thread; only capture what
+        # cannot travel across threads (the traceback)
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": record.msg,
+        }
+        line.update(getattr(record, "ctx", {}))
+        line.update(getattr(record, "fields", {}))
+        if getattr(record, "suppressed", 0):
+            line["suppressed"] = record.suppressed
+        if getattr(record, "exc", None):
+            line["exc"] = record.exc
+        return redact(json.dumps(line, ensure_ascii=False, default=str))
+
+
+log = logging.getLogger("dental_bot")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+LOG_QUEUE = queue.Queue(maxsize=10000)
+_queue_handler = NonBlockingQueueHandler(LOG_QUEUE)
+_queue_handler.addFilter(ContextFilter())
+log.addHandler(_queue_handler)
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(JsonFormatter())
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, _stdout_handler)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+
+
+def log_event(event, level=logging.INFO, sample=1.0, keep=False, exc_info=False, **fields):
+    log.log(level, event, exc_info=exc_info, extra={"fields": fields, "sample": sample, "keep": keep})
+
+
+def set_log_context(**values):
+    ctx = LOG_CTX.get()
+    if ctx is not None:
+        ctx.update(values)
+
+
+# -----------------------------------------
+# TRACING (span per update, children per DB / HTTP / encoding step)
+# -----------------------------------------
+CURRENT_SPAN = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        # Spans of one trace share this dict: finished spans and per-category timings
+        self.trace = parent.trace if parent else {
+            "id": secrets.token_hex(16), "spans": [], "intervals": {}, "ms": {}
+        }
+        self.span_id = secrets.token_hex(8)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def finish(self):
+        self.end_ns = time.time_ns()
+        self.trace["spans"].append(self)
+        if self.parent:
+            category = self.name.split(".", 1)[0]
+            self.trace["intervals"].setdefault(category, []).append((self.start_ns, self.end_ns))
+            return
+        # Wall time per category ("db", "telegram", "gemini", ...). Nested spans of one
+        # category and parallel ones (hedged Gemini attempts) overlap, so intervals are
+        # merged rather than summed: a category never exceeds the update's duration.
+        self.trace["ms"] = {
+            category: round(covered_ns(intervals) / 1e6, 2)
+            for category, intervals in self.trace["intervals"].items()
+        }
+        if TRACE_EXPORT_FILE:
+            trace_log.info("trace", extra={"otlp": otlp_payload(self.trace)})
+
+    def to_otlp(self):
+        attributes = []
+        for key, value in self.attrs.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                typed = {"boolValue": value}
+            elif isinstance(value, int):
+                typed = {"intValue": str(value)}
+            elif isinstance(value, float):
+                typed = {"doubleValue": value}
+            else:
+                typed = {"stringValue": str(value)}
+            attributes.append({"key": key, "value": typed})
+        out = {
+            "traceId": self.trace["id"],
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 3 if self.name.split(".", 1)[0] in ("telegram", "gemini", "http") else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": attributes,
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+        if self.parent:
+            out["parentSpanId"] = self.parent.span_id
+        return out
+
+
+def covered_ns(intervals):
+    total, reach = 0, None
+    for start, end in sorted(intervals):
+        if reach is None or start > reach:
+            total += end - start
+            reach = end
+        elif end > reach:
+            total += end - reach
+            reach = end
+    return total
+
+
+def otlp_payload(trace):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [{"key": "service.name", "value": {"stringValue": "dental-bot"}}]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "dental_bot"}, "spans": [s.to_otlp() for s in trace["spans"]]}
+                ],
+            }
+        ]
+    }
+
+
+@contextlib.contextmanager
+def span(name, root=False, **attrs):
+    # Outside a traced update (startup, scheduler) child spans are free no-ops
+    parent = CURRENT_SPAN.get()
+    if parent is None and not root:
+        yield None
+        return
+    current = Span(name, parent, attrs)
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        current.finish()
+
+
+def traced(name):
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class OtlpFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(json.dumps(record.otlp, separators=(",", ":")))
+
+
+# Same queue-and-listener pattern as the main log, writing to the trace file
+trace_log = logging.getLogger("dental_bot.trace")
+trace_log.propagate = False
+if TRACE_EXPORT_FILE:
+    trace_log.setLevel(logging.INFO)
+    TRACE_QUEUE = queue.Queue(maxsize=1000)
+    trace_log.addHandler(NonBlockingQueueHandler(TRACE_QUEUE))
+    _trace_file_handler = logging.FileHandler(TRACE_EXPORT_FILE, encoding="utf-8")
+    _trace_file_handler.setFormatter(OtlpFormatter())
+    TRACE_LISTENER = logging.handlers.QueueListener(TRACE_QUEUE, _trace_file_handler)
+    TRACE_LISTENER.start()
+    atexit.register(TRACE_LISTENER.stop)
+
+
+# -----------------------------------------
+# SAMPLING PROFILER (folded stacks, flamegraph-ready)
+# -----------------------------------------
+PROFILE_LOCK = threading.Lock()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_ids, seconds, interval):
+    # Runs on a worker thread; reads other threads' frames without pausing them
+    counts = Counter()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (thread_ids and ident not in thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
 if not TELEGRAM_TOKEN:
-    print("❌ ERROR: TELEGRAM_BOT_TOKEN is missing!")
+    log_event("config_missing", logging.ERROR, var="TELEGRAM_BOT_TOKEN")
 if not GOOGLE_API_KEY:
-    print("❌ ERROR: GOOGLE_API_KEY is missing!")
+    log_event("config_missing", logging.ERROR, var="GOOGLE_API_KEY")
 
 # -----------------------------------------
 # LANGUAGE NAMES FOR GEMINI
@@ -62,7 +430,9 @@ TRANS = {
         "booking_prompt": "برای چه خدمتی نوبت می‌خواهید؟",
         "doctor_prompt": "لطفاً پزشک مورد نظر خود را انتخاب کنید:",
         "any_doctor": "فرقی نمی‌کند",
+        "day_prompt": "لطفاً روز مورد نظر خود را انتخاب کنید:",
         "time_prompt": "لطفاً یکی از زمان‌های خالی زیر را انتخاب کنید (زمان به وقت دبی):",
+        "back_button": "بازگشت",
         "booking_done": "✅ نوبت شما با موفقیت رزرو شد. منتظر دیدار شما هستیم.",
         "photo_analyzing": "🖼 در حال بررسی تصویر دندان شما توسط هوش مصنوعی... لطفاً صبر کنید.",
         "photo_disclaimer": "\n\n⚠️ توجه: این تحلیل توسط هوش مصنوعی انجام شده و جایگزین تشخیص پزشک نیست.",
@@ -71,6 +441,8 @@ TRANS = {
         "no_slots": "در حال حاضر وقت خالی برای ۷ روز آینده موجود نیست. لطفاً با پذیرش تماس بگیرید.",
         "cancelled": "عملیات لغو شد.",
         "reminder_msg": "{name} عزیز، یادآوری: شما فردا ({date}) ساعت {time} نوبت دندانپزشکی دارید.",
+        "reminder_today_msg": "{name} عزیز، یادآوری: شما امروز ساعت {time} نوبت دندانپزشکی دارید.",
+        "reminder_date_msg": "{name} عزیز، یادآوری: شما در تاریخ {date} ساعت {time} نوبت دندانپزشکی دارید.",
         "ask_prompt": "لطفاً سوال خود را بنویسید یا عکس دندان خود را ارسال کنید تا هوش مصنوعی بررسی کند:",
         "name_error": "⛔️ لطفاً روی دکمه‌های زبان کلیک نکنید. نام خود را تایپ کنید:",
         "cancel_button": "لغو",
@@ -98,7 +470,9 @@ TRANS = {
         "booking_prompt": "Which service do you need?",
         "doctor_prompt": "Please select your preferred doctor:",
         "any_doctor": "Any Doctor",
+        "day_prompt": "Please choose a day:",
         "time_prompt": "Please select an available slot (Dubai Time):",
+        "back_button": "Back",
         "booking_done": "✅ Appointment confirmed. We look forward to seeing you.",
         "photo_analyzing": "🖼 Analyzing your dental image with AI... Please wait.",
         "photo_disclaimer": "\n\n⚠️ Note: This analysis is AI-generated and is NOT a medical diagnosis.",
@@ -107,6 +481,8 @@ TRANS = {
         "no_slots": "No slots available for the next 7 days. Please call reception.",
         "cancelled": "Cancelled.",
         "reminder_msg": "Dear {name}, Reminder: You have an appointment tomorrow ({date}) at {time}.",
+        "reminder_today_msg": "Dear {name}, Reminder: You have an appointment today at {time}.",
+        "reminder_date_msg": "Dear {name}, Reminder: You have an appointment on {date} at {time}.",
         "ask_prompt": "Please type your question or send a dental photo for AI analysis:",
         "name_error": "⛔️ Please do not click the language buttons. Type your name:",
         "cancel_button": "Cancel",
@@ -134,7 +510,9 @@ TRANS = {
         "booking_prompt": "ما هي الخدمة المطلوبة؟",
         "doctor_prompt": "الرجاء اختيار الطبيب المفضل:",
         "any_doctor": "أي طبيب",
+        "day_prompt": "الرجاء اختيار اليوم:",
         "time_prompt": "الرجاء اختيار وقت من الأوقات المتاحة (توقيت دبي):",
+        "back_button": "رجوع",
         "booking_done": "✅ تم تأكيد الحجز. ننتظر زیارتكم.",
         "photo_analyzing": "🖼 جاري تحليل الصورة بالذكاء الاصطناعي...",
         "photo_disclaimer": "\n\n⚠️ ملاحظة: هذا تحليل ذكي ولا يعتبر تشخیصاً طبیاً.",
@@ -143,6 +521,8 @@ TRANS = {
         "no_slots": "لا توجد مواعيد متاحة للأيام السبعة القادمة. الرجاء الاتصال بالاستقبال.",
         "cancelled": "تم الإلغاء.",
         "reminder_msg": "عزيزي {name}، تذكير: لديك موعد غداً ({date}) الساعة {time}.",
+        "reminder_today_msg": "عزيزي {name}، تذكير: لديك موعد اليوم الساعة {time}.",
+        "reminder_date_msg": "عزيزي {name}، تذكير: لديك موعد بتاريخ {date} الساعة {time}.",
         "ask_prompt": "الرجاء كتابة سؤالك أو إرسال صورة للأسنان للتحليل بالذكاء الاصطناعي:",
         "name_error": "⛔️ الرجاء عدم الضغط على الأزرار. اكتب اسمك:",
         "cancel_button": "إلغاء",
@@ -170,7 +550,9 @@ TRANS = {
         "booking_prompt": "Какая услуга вам нужна?",
         "doctor_prompt": "Выберите врача:",
         "any_doctor": "Любой врач",
+        "day_prompt": "Выберите день:",
         "time_prompt": "Выберите свободное время (время Дубая):",
+        "back_button": "Назад",
         "booking_done": "✅ Ваша запись подтверждена.",
         "photo_analyzing": "🖼 ИИ анализирует ваш снимок... Пожалуйста, подождите.",
         "photo_disclaimer": "\n\n⚠️ Примечание: Это анализ ИИ, а не медицинский диагноз.",
@@ -179,6 +561,8 @@ TRANS = {
         "no_slots": "Нет свободного времени на ближайшие 7 дней.",
         "cancelled": "Отменено.",
         "reminder_msg": "Уважаемый(ая) {name}, напоминание: у вас прием завтра ({date}) в {time}.",
+        "reminder_today_msg": "Уважаемый(ая) {name}, напоминание: у вас прием сегодня в {time}.",
+        "reminder_date_msg": "Уважаемый(ая) {name}, напоминание: у вас прием {date} в {time}.",
         "ask_prompt": "Пожалуйста, напишите вопрос или отправьте фото зубов для анализа ИИ:",
         "name_error": "⛔️ Не нажимайте кнопки. Введите имя:",
         "cancel_button": "Отмена",
@@ -193,6 +577,26 @@ TRANS = {
     },
 }
 
+# -----------------------------------------
+# BOOKING CATALOGUE (codes travel in callback data)
+# -----------------------------------------
+SERVICES = {
+    "imp": {"fa": "ایمپلنت و کاشت دندان", "en": "Implants", "ar": "زراعة الأسنان", "ru": "Имплантация"},
+    "ort": {"fa": "ارتودنسی", "en": "Orthodontics", "ar": "تقويم الأسنان", "ru": "Ортодонтия"},
+    "ven": {"fa": "لمینت و کامپوزیت", "en": "Veneers & Composite", "ar": "القشور الخزفية", "ru": "Виниры"},
+    "cln": {"fa": "جرمگیری و بلیچینگ", "en": "Scaling & Whitening", "ar": "تنظيف وتبييض الأسنان", "ru": "Чистка и отбеливание"},
+    "rct": {"fa": "عصب‌کشی و ترمیم", "en": "Root Canal", "ar": "علاج الجذور", "ru": "Лечение каналов"},
+}
+DOCTORS = {"d1": "Dr. One", "d2": "Dr. Two"}
+# Slot buttons per page in the inline time picker
+SLOTS_PER_PAGE = 8
+# The first few slots shown to a patient are held for them this long, so concurrent
+# bookers are offered different times instead of racing for the same ones. Holds never
+# take a day's last unheld free slot, so nobody is ever locked out of a day.
+SLOT_HOLD_SECONDS = int(os.getenv("SLOT_HOLD_SECONDS", "90"))
+SLOT_HOLDS_PER_BOOKER = 2
+HOLD_STATS = {"offered": 0, "held": 0, "hold_conflicts": 0, "book_attempts": 0, "book_conflicts": 0}
+
 # -----------------------------------------
 # DATABASE
 # -----------------------------------------
@@ -216,10 +620,65 @@ def init_db():
             )
         """
         )
+        # Migrate older databases: booking details and a change marker for exports
+        slot_cols = {r[1] for r in conn.execute("PRAGMA table_info(slots)").fetchall()}
+        for col in ("service", "doctor", "booked_at"):
+            if col not in slot_cols:
+                conn.execute(f"ALTER TABLE slots ADD COLUMN {col} TEXT")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Patients loaded from the clinic's records, keyed by normalised phone. When the
+        # patient registers with the bot, chat_id is filled in and the record's name and
+        # WhatsApp are copied onto their users row.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS patients (phone TEXT PRIMARY KEY, name TEXT, whatsapp TEXT, "
+            "lang TEXT, chat_id INTEGER, updated_at TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS slot_holds (slot_id INTEGER PRIMARY KEY, chat_id INTEGER, expires_at REAL)"
+        )
+        # One row per reminder sent, so each configured offset fires at most once per booking
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reminders_sent (slot_id INTEGER, offset_min INTEGER, "
+            "sent_at TEXT, PRIMARY KEY (slot_id, offset_min))"
+        )
+        # Bookings reminded by the old cron (slots.reminder_sent) predate per-offset
+        # tracking: count every offset as sent so the scheduler does not repeat them
+        legacy = conn.execute(
+            "SELECT id FROM slots WHERE is_booked=1 AND reminder_sent=1 AND NOT EXISTS "
+            "(SELECT 1 FROM reminders_sent r WHERE r.slot_id = slots.id)"
+        ).fetchall()
+        conn.executemany(
+            "INSERT OR IGNORE INTO reminders_sent (slot_id, offset_min) VALUES (?,?)",
+            [(slot_id, offset) for (slot_id,) in legacy for offset in REMINDER_OFFSET_MINUTES],
+        )
+        # Analytics rollups, updated incrementally as events happen
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_bookings (day TEXT, service TEXT, doctor TEXT, "
+            "bookings INTEGER DEFAULT 0, PRIMARY KEY (day, service, doctor))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_slot_hours (hour INTEGER PRIMARY KEY, "
+            "offered INTEGER DEFAULT 0, booked INTEGER DEFAULT 0)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_registrations (lang TEXT PRIMARY KEY, registrations INTEGER DEFAULT 0)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_ai_calls (day TEXT, kind TEXT, outcome TEXT, "
+            "calls INTEGER DEFAULT 0, PRIMARY KEY (day, kind, outcome))"
+        )
+        # One-off seed so utilisation is meaningful on databases created before rollups
+        if not conn.execute("SELECT 1 FROM stats_slot_hours LIMIT 1").fetchone():
+            conn.execute(
+                "INSERT INTO stats_slot_hours (hour, offered, booked) "
+                "SELECT CAST(substr(datetime_str, 12, 2) AS INTEGER), COUNT(*), SUM(is_booked) "
+                "FROM slots GROUP BY 1"
+            )
         conn.commit()
     ensure_future_slots()
 
 
+@traced("db.ensure_future_slots")
 def ensure_future_slots():
     with sqlite3.connect(DB_NAME) as conn:
         now = datetime.now(DUBAI_TZ)
@@ -227,45 +686,77 @@ def ensure_future_slots():
             date = now + timedelta(days=day)
             for hour in [10, 12, 14, 16, 18, 20]:
                 dt_str = f"{date.strftime('%Y-%m-%d')} {hour:02d}:00"
-                try:
-                    conn.execute("INSERT INTO slots (datetime_str) VALUES (?)", (dt_str,))
-                except Exception:
-                    pass
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO slots (datetime_str) VALUES (?)", (dt_str,)
+                )
+                if cursor.rowcount > 0:
+                    bump_stat(conn, "stats_slot_hours", {"hour": hour}, "offered")
         yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+        cursor = conn.execute(
+            "DELETE FROM slots WHERE datetime_str < ? AND is_booked=1", (yesterday,)
+        )
+        if cursor.rowcount > 0:
+            touch_bookings(conn)
         conn.execute("DELETE FROM slots WHERE datetime_str < ?", (yesterday,))
         conn.commit()
 
 
+# Params: chat_id, name, whatsapp, phone, lang-for-insert, lang-for-update.
+# Empty values never overwrite what is already stored.
+USER_UPSERT_SQL = (
+    "INSERT INTO users (chat_id, name, whatsapp, phone, lang) VALUES (?,?,?,?,?) "
+    "ON CONFLICT (chat_id) DO UPDATE SET name=COALESCE(excluded.name, users.name), "
+    "whatsapp=COALESCE(excluded.whatsapp, users.whatsapp), phone=COALESCE(excluded.phone, users.phone), "
+    "lang=COALESCE(?, users.lang)"
+)
+
+
+def user_upsert_params(chat_id, name=None, whatsapp=None, phone=None, lang=None):
+    return (chat_id, name or None, whatsapp or None, phone or None, lang or "fa", lang or None)
+
+
+@traced("db.upsert_user")
 def upsert_user(chat_id, name=None, whatsapp=None, phone=None, lang=None):
     with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,))
-        if cursor.fetchone():
-            q = "UPDATE users SET "
-            params = []
-            if name:
-                q += "name=?, "
-                params.append(name)
-            if whatsapp:
-                q += "whatsapp=?, "
-                params.append(whatsapp)
-            if phone:
-                q += "phone=?, "
-                params.append(phone)
-            if lang:
-                q += "lang=?, "
-                params.append(lang)
-            if params:
-                q = q.rstrip(", ") + " WHERE chat_id=?"
-                params.append(chat_id)
-                conn.execute(q, tuple(params))
-        else:
-            conn.execute(
-                "INSERT INTO users (chat_id, name, whatsapp, phone, lang) VALUES (?,?,?,?,?)",
-                (chat_id, name, whatsapp, phone, lang or "fa"),
-            )
+        conn.execute(USER_UPSERT_SQL, user_upsert_params(chat_id, name, whatsapp, phone, lang))
+        touch_bookings(conn)
+        conn.commit()
+
+
+@traced("db.register_user")
+def register_user(chat_id, name=None, whatsapp=None, phone=None, lang=None):
+    # Completes registration; the counter and the patient link share the upsert's
+    # transaction so they never drift from users
+    with sqlite3.connect(DB_NAME) as conn:
+        row = conn.execute("SELECT phone FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+        patient = link_patient(conn, chat_id, phone)
+        if patient:
+            # The clinic's records win for name and WhatsApp (they feed exports and
+            # reception); the language the patient just picked in the bot is kept
+            name = patient[0] or name
+            whatsapp = patient[1] or whatsapp
+            lang = lang or patient[2]
+        conn.execute(USER_UPSERT_SQL, user_upsert_params(chat_id, name, whatsapp, phone, lang))
+        touch_bookings(conn)
+        # Re-running /start keeps the row; only count first-time registrations
+        if not row or not row[0]:
+            bump_stat(conn, "stats_registrations", {"lang": lang or "fa"}, "registrations")
         conn.commit()
 
 
+def link_patient(conn, chat_id, phone):
+    # Connects an imported patient record to the Telegram account that just verified it;
+    # returns its (name, whatsapp, lang), or None when the clinic has no such record
+    phone = normalize_phone(phone)
+    if not phone:
+        return None
+    conn.execute("UPDATE patients SET chat_id=? WHERE phone=?", (chat_id, phone))
+    return conn.execute(
+        "SELECT name, whatsapp, lang FROM patients WHERE phone=?", (phone,)
+    ).fetchone()
+
+
+@traced("db.get_user")
 def get_user(chat_id):
     with sqlite3.connect(DB_NAME) as conn:
         return conn.execute(
@@ -273,56 +764,320 @@ def get_user(chat_id):
         ).fetchone()
 
 
+@traced("db.get_all_users")
 def get_all_users():
     with sqlite3.connect(DB_NAME) as conn:
         return [r[0] for r in conn.execute("SELECT chat_id FROM users").fetchall()]
 
 
-def get_available_slots():
+@traced("db.get_state")
+def get_state(chat_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        row = conn.execute(
+            "SELECT flow_type, step, data FROM states WHERE chat_id=?", (chat_id,)
+        ).fetchone()
+    if not row:
+        return None
+    return {"flow_type": row[0], "step": row[1], "data": json.loads(row[2]) if row[2] else {}}
+
+
+@traced("db.set_state")
+def set_state(chat_id, flow_type, step, data):
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
+            (chat_id, flow_type, step, json.dumps(data)),
+        )
+        conn.commit()
+
+
+@traced("db.clear_state")
+def clear_state(chat_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
+        conn.commit()
+
+
+# Free slots, minus those currently held for someone else (chat_id=None ignores holds)
+NOT_HELD_BY_OTHERS = (
+    "AND (? IS NULL OR NOT EXISTS (SELECT 1 FROM slot_holds h "
+    "WHERE h.slot_id = slots.id AND h.chat_id != ? AND h.expires_at > ?))"
+)
+
+
+@traced("db.get_available_days")
+def get_available_days(chat_id=None):
     ensure_future_slots()
     with sqlite3.connect(DB_NAME) as conn:
         now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
-        return [
-            r[0]
-            for r in conn.execute(
-                "SELECT datetime_str FROM slots WHERE is_booked=0 AND datetime_str > ? "
-                "ORDER BY datetime_str ASC LIMIT 10",
-                (now_str,),
-            ).fetchall()
-        ]
+        return conn.execute(
+            "SELECT substr(datetime_str, 1, 10), COUNT(*) FROM slots "
+            f"WHERE is_booked=0 AND datetime_str > ? {NOT_HELD_BY_OTHERS} GROUP BY 1 ORDER BY 1 ASC",
+            (now_str, chat_id, chat_id, time.time()),
+        ).fetchall()
 
 
-def book_slot_atomic(dt_str, chat_id):
+@traced("db.get_available_slots")
+def get_available_slots(day, offset=0, limit=SLOTS_PER_PAGE, chat_id=None):
+    # Returns (id, datetime_str) rows for one day; one extra row signals a next page
+    with sqlite3.connect(DB_NAME) as conn:
+        now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
+        return conn.execute(
+            "SELECT id, datetime_str FROM slots WHERE is_booked=0 AND datetime_str > ? "
+            f"AND datetime_str LIKE ? {NOT_HELD_BY_OTHERS} "
+            "ORDER BY datetime_str ASC LIMIT ? OFFSET ?",
+            (now_str, f"{day}%", chat_id, chat_id, time.time(), limit + 1, offset),
+        ).fetchall()
+
+
+@traced("db.hold_slots")
+def hold_slots(slot_ids, chat_id, day, ttl=SLOT_HOLD_SECONDS):
+    # Replaces this chat's holds with holds on the first SLOT_HOLDS_PER_BOOKER of slot_ids,
+    # leaving at least one free slot of the day unheld. Returns (acquired, conflicts).
+    # BEGIN IMMEDIATE makes the count and the inserts one atomic step across bookers.
+    now = time.time()
+    now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM slot_holds WHERE expires_at <= ? OR chat_id = ?", (now, chat_id))
+        unheld = conn.execute(
+            "SELECT COUNT(*) FROM slots WHERE is_booked=0 AND datetime_str > ? AND datetime_str LIKE ? "
+            "AND NOT EXISTS (SELECT 1 FROM slot_holds h WHERE h.slot_id = slots.id)",
+            (now_str, f"{day}%"),
+        ).fetchone()[0]
+        budget = min(SLOT_HOLDS_PER_BOOKER, unheld - 1)
+        acquired = conflicts = 0
+        for slot_id in slot_ids:
+            if acquired >= budget:
+                break
+            cursor = conn.execute(
+                "INSERT INTO slot_holds (slot_id, chat_id, expires_at) "
+                "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM slots WHERE id=? AND is_booked=0) "
+                "ON CONFLICT (slot_id) DO NOTHING",
+                (slot_id, chat_id, now + ttl, slot_id),
+            )
+            if cursor.rowcount > 0:
+                acquired += 1
+            else:
+                conflicts += 1
+        conn.commit()
+    return acquired, conflicts
+
+
+@traced("db.release_holds")
+def release_holds(chat_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("DELETE FROM slot_holds WHERE chat_id=?", (chat_id,))
+        conn.commit()
+
+
+@traced("db.book_slot_atomic")
+def book_slot_atomic(slot_id, chat_id, service=None, doctor=None):
+    # Returns the booked datetime_str, or None if the slot was taken (or is held for
+    # someone else) meanwhile, or has already started (a picker left open for hours)
+    now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
     with sqlite3.connect(DB_NAME) as conn:
         cursor = conn.execute(
-            "UPDATE slots SET is_booked=1, booked_by=? WHERE datetime_str=? AND is_booked=0",
-            (chat_id, dt_str),
+            "UPDATE slots SET is_booked=1, booked_by=?, service=?, doctor=?, booked_at=? "
+            "WHERE id=? AND is_booked=0 AND datetime_str > ? AND NOT EXISTS (SELECT 1 FROM slot_holds h "
+            "WHERE h.slot_id = slots.id AND h.chat_id != ? AND h.expires_at > ?)",
+            (
+                chat_id, service, doctor, datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                slot_id, now_str, chat_id, time.time(),
+            ),
         )
+        booked = cursor.rowcount > 0
+        dt_str = None
+        if booked:
+            conn.execute("DELETE FROM slot_holds WHERE slot_id=? OR chat_id=?", (slot_id, chat_id))
+            dt_str = conn.execute(
+                "SELECT datetime_str FROM slots WHERE id=?", (slot_id,)
+            ).fetchone()[0]
+            touch_bookings(conn)
+            # Same transaction as the booking, so rollups never drift from slots
+            today = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d")
+            bump_stat(
+                conn,
+                "stats_bookings",
+                {"day": today, "service": service or "General", "doctor": doctor or "Any"},
+                "bookings",
+            )
+            bump_stat(conn, "stats_slot_hours", {"hour": int(dt_str[11:13])}, "booked")
         conn.commit()
-        return cursor.rowcount > 0
+        return dt_str
 
 
-def get_pending_reminders():
-    tomorrow = (datetime.now(DUBAI_TZ) + timedelta(days=1)).strftime("%Y-%m-%d")
+def get_upcoming_bookings():
+    now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
     with sqlite3.connect(DB_NAME) as conn:
-        q = """
-            SELECT slots.id, slots.datetime_str, users.chat_id, users.name, users.lang
+        bookings = conn.execute(
+            "SELECT id, datetime_str, booked_at FROM slots WHERE is_booked=1 AND datetime_str > ?",
+            (now_str,),
+        ).fetchall()
+        sent = conn.execute(
+            "SELECT reminders_sent.slot_id, reminders_sent.offset_min FROM reminders_sent "
+            "JOIN slots ON slots.id = reminders_sent.slot_id WHERE slots.datetime_str > ?",
+            (now_str,),
+        ).fetchall()
+    return bookings, set(sent)
+
+
+@traced("db.get_reminder_target")
+def get_reminder_target(slot_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        return conn.execute(
+            """
+            SELECT slots.datetime_str, users.chat_id, users.name, users.lang
             FROM slots
             JOIN users ON slots.booked_by = users.chat_id
-            WHERE is_booked=1 AND reminder_sent=0 AND datetime_str LIKE ?
-        """
-        return conn.execute(q, (f"{tomorrow}%",)).fetchall()
+            WHERE slots.id=? AND slots.is_booked=1
+            """,
+            (slot_id,),
+        ).fetchone()
 
 
-def mark_reminder_as_sent(slot_id):
+@traced("db.mark_reminder_as_sent")
+def mark_reminder_as_sent(slot_id, offset_min):
+    # Claims the reminder; False means it was already sent (or claimed) elsewhere
     with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO reminders_sent (slot_id, offset_min, sent_at) VALUES (?,?,?)",
+            (slot_id, offset_min, datetime.now(timezone.utc).isoformat(timespec="seconds")),
+        )
         conn.execute("UPDATE slots SET reminder_sent=1 WHERE id=?", (slot_id,))
         conn.commit()
+        return cursor.rowcount > 0
+
+
+def touch_bookings(conn):
+    # Change marker behind ETag/Last-Modified on the export endpoints. Exports carry the
+    # patient's contact details too, so user writes touch it as well as bookings.
+    # Kept to the microsecond so two edits within one second still change the ETag.
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('bookings_changed_at', ?)",
+        (datetime.now(timezone.utc).isoformat(),),
+    )
+
+
+@traced("db.get_bookings_changed_at")
+def get_bookings_changed_at():
+    with sqlite3.connect(DB_NAME) as conn:
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key='bookings_changed_at'"
+        ).fetchone()
+    if row:
+        return datetime.fromisoformat(row[0])
+    return datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def iter_bookings(start=None, end=None):
+    # Own connection, stepped lazily: only EXPORT_CHUNK_SIZE rows are in memory at once.
+    # The response may be iterated from different worker threads, hence check_same_thread.
+    q = """
+        SELECT slots.id, slots.datetime_str, slots.service, slots.doctor,
+               users.name, users.whatsapp, users.phone, users.lang, slots.booked_by
+        FROM slots
+        LEFT JOIN users ON slots.booked_by = users.chat_id
+        WHERE slots.is_booked=1 AND slots.datetime_str >= ? AND slots.datetime_str < ?
+        ORDER BY slots.datetime_str ASC
+    """
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    try:
+        cursor = conn.execute(q, (start or "", end or "9999"))
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+# -----------------------------------------
+# ANALYTICS ROLLUPS
+# -----------------------------------------
+def bump_stat(conn, table, keys, column):
+    # Table/column names are internal constants; only key values are user data
+    cols = ", ".join(keys)
+    marks = ", ".join("?" for _ in keys)
+    conn.execute(
+        f"INSERT INTO {table} ({cols}, {column}) VALUES ({marks}, 1) "
+        f"ON CONFLICT ({cols}) DO UPDATE SET {column} = {column} + 1",
+        tuple(keys.values()),
+    )
+
+
+@traced("db.record_ai_call")
+def record_ai_call(kind, outcome):
+    today = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d")
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            bump_stat(
+                conn, "stats_ai_calls", {"day": today, "kind": kind, "outcome": outcome}, "calls"
+            )
+            conn.commit()
+    except sqlite3.Error:
+        # Analytics must never break the reply path
+        pass
+
+
+@traced("db.get_stats")
+def get_stats(days=30):
+    since = (datetime.now(DUBAI_TZ) - timedelta(days=days)).strftime("%Y-%m-%d")
+    with sqlite3.connect(DB_NAME) as conn:
+        per_day = conn.execute(
+            "SELECT day, SUM(bookings) FROM stats_bookings WHERE day >= ? GROUP BY day ORDER BY day",
+            (since,),
+        ).fetchall()
+        per_service = conn.execute(
+            "SELECT service, SUM(bookings) FROM stats_bookings WHERE day >= ? "
+            "GROUP BY service ORDER BY 2 DESC",
+            (since,),
+        ).fetchall()
+        per_doctor = conn.execute(
+            "SELECT doctor, SUM(bookings) FROM stats_bookings WHERE day >= ? "
+            "GROUP BY doctor ORDER BY 2 DESC",
+            (since,),
+        ).fetchall()
+        hours = conn.execute(
+            "SELECT hour, offered, booked FROM stats_slot_hours ORDER BY hour"
+        ).fetchall()
+        registrations = conn.execute(
+            "SELECT lang, registrations FROM stats_registrations ORDER BY lang"
+        ).fetchall()
+        ai_calls = conn.execute(
+            "SELECT day, kind, outcome, calls FROM stats_ai_calls WHERE day >= ? ORDER BY day",
+            (since,),
+        ).fetchall()
+
+    ai_per_day = {}
+    for day, kind, outcome, calls in ai_calls:
+        entry = ai_per_day.setdefault(day, {"total": 0})
+        entry["total"] += calls
+        entry[f"{kind}_{outcome}"] = entry.get(f"{kind}_{outcome}", 0) + calls
+
+    return {
+        "since": since,
+        "bookings_per_day": dict(per_day),
+        "bookings_per_service": dict(per_service),
+        "bookings_per_doctor": dict(per_doctor),
+        "utilisation_by_hour": {
+            f"{hour:02d}:00": {
+                "offered": offered,
+                "booked": booked,
+                "rate": round(booked / offered, 3) if offered else None,
+            }
+            for hour, offered, booked in hours
+        },
+        "registrations_per_language": dict(registrations),
+        "ai_calls_per_day": ai_per_day,
+    }
 
 
 # -----------------------------------------
 # TELEGRAM & AI CLIENTS
 # -----------------------------------------
+@traced("telegram.sendMessage")
 async def send_message(chat_id: int, text: str, reply_markup: dict = None, parse_mode: str = None):
     try:
         payload = {
@@ -338,11 +1093,53 @@ async def send_message(chat_id: int, text: str, reply_markup: dict = None, parse
             payload["parse_mode"] = "Markdown"
 
         async with httpx.AsyncClient(timeout=20) as client:
-            await client.post(f"{TELEGRAM_URL}/sendMessage", json=payload)
+            r = await client.post(f"{TELEGRAM_URL}/sendMessage", json=payload)
+            return r.json().get("result")
+    except Exception as e:
+        log_event("telegram_call_failed", logging.WARNING, method="sendMessage", error=repr(e))
+        return None
+
+
+@traced("telegram.editMessageText")
+async def edit_message_text(chat_id: int, message_id: int, text: str, reply_markup: dict = None):
+    try:
+        payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        async with httpx.AsyncClient(timeout=20) as client:
+            await client.post(f"{TELEGRAM_URL}/editMessageText", json=payload)
+    except Exception as e:
+        log_event("telegram_call_failed", logging.WARNING, method="editMessageText", error=repr(e))
+
+
+@traced("telegram.editMessageReplyMarkup")
+async def edit_message_reply_markup(chat_id: int, message_id: int, reply_markup: dict):
+    try:
+        payload = {"chat_id": chat_id, "message_id": message_id, "reply_markup": reply_markup}
+        async with httpx.AsyncClient(timeout=20) as client:
+            await client.post(f"{TELEGRAM_URL}/editMessageReplyMarkup", json=payload)
+    except Exception as e:
+        log_event(
+            "telegram_call_failed", logging.WARNING, method="editMessageReplyMarkup", error=repr(e)
+        )
+
+
+@traced("telegram.answerCallbackQuery")
+async def answer_callback_query(callback_id: str, text: str = None):
+    # Always answer, otherwise the client keeps a spinner on the button
+    try:
+        payload = {"callback_query_id": callback_id}
+        if text:
+            payload["text"] = text
+        async with httpx.AsyncClient(timeout=20) as client:
+            await client.post(f"{TELEGRAM_URL}/answerCallbackQuery", json=payload)
     except Exception as e:
-        print(f"Send Error: {e}")
+        log_event(
+            "telegram_call_failed", logging.WARNING, method="answerCallbackQuery", error=repr(e)
+        )
 
 
+@traced("telegram.getFile")
 async def get_file_info(file_id):
     try:
         async with httpx.AsyncClient() as client:
@@ -352,31 +1149,224 @@ async def get_file_info(file_id):
         return None
 
 
-async def call_gemini_api(body, lang: str = "en"):
-    # Updated to gemini-1.5-flash. If this fails, try 'gemini-pro'
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+# -----------------------------------------
+# GEMINI RESILIENCE (retries, hedging, circuit breaker)
+# -----------------------------------------
+AI_BREAKER = {"state": "closed", "failures": 0, "opened_at": 0.0, "probing": False}
+AI_HEDGE_STATS = {
+    "calls": 0,
+    "primary_wins": 0,
+    "hedged": 0,  # primary too slow, secondary raced against it
+    "hedge_wins": 0,  # ...and the secondary answered first
+    "fallbacks": 0,  # primary failed, secondary tried alone
+    "fallback_successes": 0,
+}
+AI_LATENCIES = deque(maxlen=200)  # seconds, primary attempts that answered or were cut off
+
+
+def is_retryable(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        return code == 429 or code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def retry_after(exc):
+    # Server-requested wait (Retry-After: seconds or HTTP date), or None
+    if not isinstance(exc, httpx.HTTPStatusError):
+        return None
+    value = exc.response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def hedge_deadline():
+    if len(AI_LATENCIES) < 20:
+        return GEMINI_HEDGE_MAX / 2
+    ordered = sorted(AI_LATENCIES)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    return min(max(p95, GEMINI_HEDGE_MIN), GEMINI_HEDGE_MAX)
+
+
+def breaker_allow():
+    if AI_BREAKER["state"] == "closed":
+        return True
+    if AI_BREAKER["state"] == "open":
+        if time.monotonic() - AI_BREAKER["opened_at"] < BREAKER_COOLDOWN:
+            return False
+        AI_BREAKER["state"] = "half_open"
+    # Half-open: let exactly one probe through
+    if AI_BREAKER["probing"]:
+        return False
+    AI_BREAKER["probing"] = True
+    return True
+
+
+def breaker_record(success):
+    if success:
+        AI_BREAKER.update(state="closed", failures=0)
+        return
+    AI_BREAKER["failures"] += 1
+    if AI_BREAKER["state"] == "half_open" or AI_BREAKER["failures"] >= BREAKER_FAILURE_THRESHOLD:
+        AI_BREAKER.update(state="open", opened_at=time.monotonic())
+
+
+def ai_health():
+    ordered = sorted(AI_LATENCIES)
+    return {
+        "breaker": {
+            "state": AI_BREAKER["state"],
+            "consecutive_failures": AI_BREAKER["failures"],
+            "retry_in": max(0.0, round(BREAKER_COOLDOWN - (time.monotonic() - AI_BREAKER["opened_at"]), 1))
+            if AI_BREAKER["state"] == "open"
+            else 0.0,
+        },
+        "hedging": dict(
+            AI_HEDGE_STATS,
+            hedge_win_rate=round(AI_HEDGE_STATS["hedge_wins"] / AI_HEDGE_STATS["hedged"], 3)
+            if AI_HEDGE_STATS["hedged"]
+            else None,
+            deadline=round(hedge_deadline(), 2),
+        ),
+        "latency": {
+            "samples": len(ordered),
+            "p50": round(ordered[len(ordered) // 2], 3) if ordered else None,
+            "p95": round(ordered[int(len(ordered) * 0.95) - 1], 3) if len(ordered) >= 20 else None,
+        },
+        "models": {"primary": GEMINI_PRIMARY_MODEL, "secondary": GEMINI_SECONDARY_MODEL},
+    }
+
+
+async def gemini_generate(client, model, body, deadline):
+    # deadline is a time.monotonic() value; backoff never sleeps past it
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
     headers = {"Content-Type": "application/json", "x-goog-api-key": GOOGLE_API_KEY}
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        started = time.monotonic()
+        try:
+            with span("gemini.generate", model=model, attempt=attempt):
+                r = await client.post(url, headers=headers, json=body)
+                r.raise_for_status()
+                answer = r.json()["candidates"][0]["content"]["parts"][0]["text"]
+            if model == GEMINI_PRIMARY_MODEL:
+                AI_LATENCIES.append(time.monotonic() - started)
+            return answer
+        except asyncio.CancelledError:
+            # Lost to the hedge or ran out of budget. Still a sample (a lower bound), or the
+            # p95 would only ever see fast calls and drift down.
+            if model == GEMINI_PRIMARY_MODEL:
+                AI_LATENCIES.append(time.monotonic() - started)
+            raise
+        except Exception as e:
+            if not is_retryable(e) or attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, GEMINI_BACKOFF_BASE * 2**attempt)
+            if time.monotonic() + delay >= deadline:
+                raise
+            await asyncio.sleep(delay)
+
+
+async def gemini_hedged(client, body):
+    # Primary first; if it has not answered by the hedge deadline, race the secondary.
+    # If the primary fails outright, the secondary is the fallback. Both models, retries
+    # and backoff included, share one GEMINI_DEADLINE budget.
+    AI_HEDGE_STATS["calls"] += 1
+    deadline = time.monotonic() + GEMINI_DEADLINE
+    primary = asyncio.create_task(gemini_generate(client, GEMINI_PRIMARY_MODEL, body, deadline))
+    tasks = [primary]
+    try:
+        async with asyncio.timeout(GEMINI_DEADLINE):
+            done, _ = await asyncio.wait({primary}, timeout=hedge_deadline())
+            if done and primary.exception() is None:
+                AI_HEDGE_STATS["primary_wins"] += 1
+                return primary.result()
+            if done and not is_retryable(primary.exception()):
+                # Bad request or blocked content: the other model would fail the same way
+                raise primary.exception()
+
+            secondary = asyncio.create_task(
+                gemini_generate(client, GEMINI_SECONDARY_MODEL, body, deadline)
+            )
+            tasks.append(secondary)
+            AI_HEDGE_STATS["fallbacks" if done else "hedged"] += 1
+            pending = {secondary} if done else {primary, secondary}
+            error = primary.exception() if done else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is primary:
+                            AI_HEDGE_STATS["primary_wins"] += 1
+                        else:
+                            AI_HEDGE_STATS["fallback_successes" if error else "hedge_wins"] += 1
+                        return task.result()
+                    if task is primary and not is_retryable(task.exception()):
+                        raise task.exception()
+                    # Prefer reporting the primary's error, it is the model we asked for
+                    error = error or task.exception()
+            raise error
+    finally:
+        # The loser of the race, or everything once the budget is spent
+        for task in tasks:
+            task.cancel()
+
+
+async def call_gemini_api(body, lang: str = "en", kind: str = "text"):
     texts = TRANS.get(lang, TRANS["en"])
+    if not breaker_allow():
+        # Upstream known to be unhealthy: fail fast instead of making the patient wait
+        record_ai_call(kind, "rejected")
+        return texts["ai_connection_error"]
+    # In half-open state this call is the single probe; it must give that slot back even
+    # when cancelled, or every later call would be rejected until a restart
+    probe = AI_BREAKER["probing"]
     try:
-        async with httpx.AsyncClient(timeout=45) as client:
-            r = await client.post(url, headers=headers, json=body)
-            r.raise_for_status()
-            return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+        async with httpx.AsyncClient(timeout=GEMINI_TIMEOUT) as client:
+            answer = await gemini_hedged(client, body)
+        breaker_record(True)
+        record_ai_call(kind, "ok")
+        return answer
     except httpx.HTTPStatusError as e:
-        error_msg = f"❌ AI Error {e.response.status_code}: {e.response.text}"
-        print(error_msg)
+        # Body is truncated: full error payloads can be large and echo the prompt
+        log_event(
+            "ai_http_error",
+            logging.ERROR,
+            kind=kind,
+            status=e.response.status_code,
+            body=e.response.text[:300],
+        )
+        # Client errors (bad request, blocked content) say nothing about upstream health
+        breaker_record(not is_retryable(e))
+        record_ai_call(kind, "error")
         return texts["ai_error"]
     except Exception as e:
-        print(f"❌ AI Connection Error: {e}")
+        log_event("ai_connection_error", logging.ERROR, kind=kind, error=repr(e))
+        breaker_record(False)
+        record_ai_call(kind, "error")
         return texts["ai_connection_error"]
+    finally:
+        if probe:
+            AI_BREAKER["probing"] = False
 
 
 async def analyze_image_with_gemini(file_path, caption, lang):
     file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            img_data = (await client.get(file_url)).content
-        b64_img = base64.b64encode(img_data).decode("utf-8")
+        with span("http.download_image"):
+            async with httpx.AsyncClient(timeout=60) as client:
+                img_data = (await client.get(file_url)).content
+        with span("encode.base64", bytes=len(img_data)):
+            b64_img = base64.b64encode(img_data).decode("utf-8")
 
         target_lang = LANG_NAMES.get(lang, "English")
         prompt = (
@@ -396,9 +1386,9 @@ async def analyze_image_with_gemini(file_path, caption, lang):
                 }
             ]
         }
-        return await call_gemini_api(body, lang)
+        return await call_gemini_api(body, lang, kind="image")
     except Exception as e:
-        print(f"Image Error: {e}")
+        log_event("image_analysis_failed", logging.ERROR, error=repr(e))
         texts = TRANS.get(lang, TRANS["en"])
         return texts["ai_connection_error"]
 
@@ -414,6 +1404,479 @@ async def ask_gemini_text(question, lang):
     return await call_gemini_api(body, lang)
 
 
+# -----------------------------------------
+# LOCAL INTENT MATCHER (answers FAQs without Gemini)
+# -----------------------------------------
+# Phrase -> weight. Multi-word phrases are strong signals; single keywords ("services",
+# "address", "booking") also show up in real questions, so they stay below
+# INTENT_MIN_CONFIDENCE and alone never trigger a canned reply.
+INTENT_PHRASES = {
+    "en": {
+        "hours": {
+            "working hours": 1.0, "opening hours": 1.0, "what time do you open": 1.0,
+            "what time do you close": 1.0, "when are you open": 1.0, "when do you open": 1.0,
+            "are you open": 1.0, "open today": 1.0, "hours": 0.6,
+        },
+        "address": {
+            "where are you located": 1.0, "where is the clinic": 1.0, "your address": 1.0,
+            "clinic address": 1.0, "how do i get there": 1.0, "how to get there": 1.0,
+            "address": 0.6, "directions": 0.6, "where are you": 0.6, "location": 0.6, "map": 0.6,
+        },
+        "services": {
+            "what services": 1.0, "your services": 1.0, "what do you offer": 1.0,
+            "services": 0.6, "treatments": 0.6,
+        },
+        "booking": {
+            "book an appointment": 1.0, "book appointment": 1.0, "make an appointment": 1.0,
+            "i want to book": 1.0, "booking": 0.6, "reserve": 0.6, "book": 0.6, "appointment": 0.6,
+        },
+    },
+    "fa": {
+        "hours": {
+            "ساعات کاری": 1.0, "ساعت کاری": 1.0, "ساعت کار": 1.0, "کی باز هستید": 1.0,
+            "چه ساعتی باز": 1.0, "ساعت چند باز": 1.0, "تا چه ساعتی": 1.0, "باز هستید": 1.0,
+            "ساعت": 0.6,
+        },
+        "address": {
+            "آدرس کلینیک": 1.0, "آدرس مطب": 1.0, "آدرس": 0.6, "نشانی": 0.6, "کجا هستید": 0.6,
+            "کجایید": 0.6, "لوکیشن": 0.6, "موقعیت": 0.6, "کجاست": 0.6,
+        },
+        "services": {"چه خدماتی": 1.0, "خدمات کلینیک": 1.0, "خدمات": 0.6, "خدماتتون": 0.6},
+        "booking": {
+            "رزرو نوبت": 1.0, "نوبت میخوام": 1.0, "نوبت می خوام": 1.0, "وقت بگیرم": 1.0,
+            "رزرو": 0.6, "نوبت": 0.6,
+        },
+    },
+    "ar": {
+        "hours": {
+            "ساعات العمل": 1.0, "مواعيد العمل": 1.0, "اوقات الدوام": 1.0, "متى تفتحون": 1.0,
+            "متى تفتحوا": 1.0, "الدوام": 0.6,
+        },
+        "address": {
+            "عنوان العيادة": 1.0, "وين موقعكم": 1.0, "اين تقعون": 1.0, "العنوان": 0.6,
+            "اين انتم": 0.6, "موقعكم": 0.6, "الموقع": 0.6, "وين": 0.5,
+        },
+        "services": {"ما هي الخدمات": 1.0, "الخدمات": 0.6, "خدماتكم": 0.6},
+        "booking": {
+            "حجز موعد": 1.0, "احجز موعد": 1.0, "اريد موعد": 1.0, "ابغى موعد": 1.0, "حجز": 0.6,
+            "موعد": 0.6,
+        },
+    },
+    "ru": {
+        "hours": {
+            "часы работы": 1.0, "время работы": 1.0, "график работы": 1.0, "режим работы": 1.0,
+            "во сколько открываетесь": 1.0, "когда открыты": 1.0, "до скольки работаете": 1.0,
+        },
+        "address": {
+            "где вы находитесь": 1.0, "как добраться": 1.0, "ваш адрес": 1.0, "адрес клиники": 1.0,
+            "адрес": 0.6, "где вы": 0.6, "местоположение": 0.6, "локация": 0.6,
+        },
+        "services": {"какие услуги": 1.0, "ваши услуги": 1.0, "услуги": 0.6, "что вы делаете": 0.6},
+        "booking": {
+            "хочу записаться": 1.0, "записаться на прием": 1.0, "записаться": 0.6,
+            "забронировать": 0.6, "запись": 0.6,
+        },
+    },
+}
+# Token prefixes that change what the patient is asking for: "cancel my booking" or
+# "parking near your location" must reach Gemini, not the booking flow or the address
+INTENT_NEGATIVE_CUES = [
+    "cancel", "chang", "reschedul", "postpon", "parking",
+    "لغو", "کنسل", "تغییر", "عوض", "جابجا", "پارکینگ",
+    "الغاء", "الغي", "تغيير", "تاجيل", "موقف", "مواقف",
+    "отмен", "перенес", "перенос", "измен", "парковк",
+]
+INTENT_MIN_CONFIDENCE = 0.8
+INTENT_FULL_WEIGHT_TOKENS = 6  # longer messages are diluted: likely a real question
+INTENT_REPLY_KEYS = {"services": "services_reply", "hours": "hours_reply", "address": "address_reply"}
+INTENT_STATS = {"checked": 0, "matched": 0, "vetoed": 0, "by_intent": {}, "match_ms_total": 0.0}
+
+# Arabic and Persian share a script but differ in a few letters; fold them to one form
+NORMALIZE_MAP = str.maketrans(
+    {
+        "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+        "ٱ": "ا", "ؤ": "و", "ئ": "ی", "ё": "е", "\u200c": " ", "\u0640": "",
+        **{chr(0x06F0 + d): str(d) for d in range(10)},  # Persian digits
+        **{chr(0x0660 + d): str(d) for d in range(10)},  # Arabic-Indic digits
+    }
+)
+ARABIC_DIACRITICS = re.compile(r"[\u064B-\u065F\u0670]")
+NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_tokens(text):
+    text = unicodedata.normalize("NFKC", text).casefold().translate(NORMALIZE_MAP)
+    text = ARABIC_DIACRITICS.sub("", text)
+    return NON_WORD.sub(" ", text).split()
+
+
+def build_intent_tries():
+    # One token trie per language; a node's "$" entry holds (intent, weight)
+    tries = {}
+    for lang, intents in INTENT_PHRASES.items():
+        root = {}
+        for intent, phrases in intents.items():
+            for phrase, weight in phrases.items():
+                node = root
+                for token in normalize_tokens(phrase):
+                    node = node.setdefault(token, {})
+                node["$"] = (intent, weight)
+        tries[lang] = root
+    return tries
+
+
+INTENT_TRIES = build_intent_tries()
+# Normalised like the input, so "إلغاء" and "الغاء" are the same cue
+INTENT_VETO = tuple(token for cue in INTENT_NEGATIVE_CUES for token in normalize_tokens(cue))
+
+
+def score_intents(tokens, trie):
+    # Longest phrase match starting at each token; matched tokens are consumed
+    scores = {}
+    i = 0
+    while i < len(tokens):
+        node, best, j = trie, None, i
+        while j < len(tokens) and tokens[j] in node:
+            node = node[tokens[j]]
+            j += 1
+            if "$" in node:
+                best = (node["$"], j)
+        if best:
+            (intent, weight), i = best
+            scores[intent] = scores.get(intent, 0.0) + weight
+        else:
+            i += 1
+    return scores
+
+
+@traced("intent.match")
+def match_intent(text, lang):
+    # Returns the intent name when confident, else None (caller falls back to Gemini)
+    started = time.perf_counter()
+    INTENT_STATS["checked"] += 1
+    tokens = normalize_tokens(text)
+    result = None
+    if any(token.startswith(INTENT_VETO) for token in tokens):
+        INTENT_STATS["vetoed"] += 1
+    elif tokens:
+        dilution = min(1.0, INTENT_FULL_WEIGHT_TOKENS / len(tokens))
+        # The user's own language first, then the others (people mix languages)
+        for l in [lang] + [l for l in INTENT_TRIES if l != lang]:
+            scores = score_intents(tokens, INTENT_TRIES.get(l, {}))
+            if not scores:
+                continue
+            ranked = sorted(scores.values(), reverse=True)
+            confidence = min(1.0, ranked[0]) * dilution
+            # Ambiguous ("address and hours?") goes to Gemini too
+            if confidence >= INTENT_MIN_CONFIDENCE and (len(ranked) == 1 or ranked[0] > ranked[1]):
+                result = max(scores, key=scores.get)
+                break
+    INTENT_STATS["match_ms_total"] += (time.perf_counter() - started) * 1000
+    if result:
+        INTENT_STATS["matched"] += 1
+        INTENT_STATS["by_intent"][result] = INTENT_STATS["by_intent"].get(result, 0) + 1
+    return result
+
+
+def intent_stats():
+    checked, matched = INTENT_STATS["checked"], INTENT_STATS["matched"]
+    # Every local match is a Gemini call not made; value it at the mean observed latency
+    avg_ai = sum(AI_LATENCIES) / len(AI_LATENCIES) if AI_LATENCIES else None
+    return {
+        "checked": checked,
+        "matched": matched,
+        "match_rate": round(matched / checked, 3) if checked else None,
+        "vetoed": INTENT_STATS["vetoed"],
+        "by_intent": dict(INTENT_STATS["by_intent"]),
+        "avg_match_ms": round(INTENT_STATS["match_ms_total"] / checked, 3) if checked else None,
+        "est_ai_seconds_saved": round(matched * avg_ai, 1) if avg_ai is not None else None,
+    }
+
+
+# -----------------------------------------
+# EXPORTS (CSV / iCalendar)
+# -----------------------------------------
+CSV_HEADER = ["slot_id", "datetime", "service", "doctor", "name", "whatsapp", "phone", "lang", "chat_id"]
+
+
+# Cells a spreadsheet would evaluate as a formula; names come straight from Telegram
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def csv_safe(value):
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_chunks(start, end):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_HEADER)
+    for rows in iter_bookings(start, end):
+        writer.writerows([csv_safe(v) for v in row] for row in rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def ics_escape(value):
+    return (
+        str(value or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def ics_line(line):
+    # RFC 5545: fold content lines longer than 75 octets
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line + "\r\n"
+    parts = []
+    while raw:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(raw))
+        # Never split inside a multi-byte UTF-8 sequence
+        while cut < len(raw) and (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode("utf-8"))
+        raw = raw[cut:]
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def ics_utc(dt):
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def ics_chunks(start, end, stamp):
+    yield "".join(
+        ics_line(l)
+        for l in (
+            "BEGIN:VCALENDAR",
+            "VERSION:2.0",
+            "PRODID:-//Dental Bot//Bookings//EN",
+            "CALSCALE:GREGORIAN",
+            "X-WR-CALNAME:Dental Bookings",
+        )
+    )
+    dtstamp = ics_utc(stamp)
+    for rows in iter_bookings(start, end):
+        out = []
+        for slot_id, dt_str, service, doctor, name, whatsapp, phone, lang, booked_by in rows:
+            begin = datetime.strptime(dt_str, "%Y-%m-%d %H:%M").replace(tzinfo=DUBAI_TZ)
+            summary = f"{service or 'General'} - {name or booked_by}"
+            details = f"WhatsApp: {whatsapp or '-'}\nPhone: {phone or '-'}\nDoctor: {doctor or 'Any'}"
+            for l in (
+                "BEGIN:VEVENT",
+                f"UID:slot-{slot_id}@dental-bot",
+                f"DTSTAMP:{dtstamp}",
+                f"DTSTART:{ics_utc(begin)}",
+                f"DTEND:{ics_utc(begin + SLOT_DURATION)}",
+                f"SUMMARY:{ics_escape(summary)}",
+                f"DESCRIPTION:{ics_escape(details)}",
+                "END:VEVENT",
+            ):
+                out.append(ics_line(l))
+        yield "".join(out)
+    yield ics_line("END:VCALENDAR")
+
+
+def parse_date_range(request: Request):
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD (end inclusive), both optional
+    bounds = []
+    for name, shift in (("start", 0), ("end", 1)):
+        value = request.query_params.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        try:
+            day = datetime.strptime(value, "%Y-%m-%d") + timedelta(days=shift)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid {name} date, expected YYYY-MM-DD")
+        bounds.append(day.strftime("%Y-%m-%d"))
+    return bounds
+
+
+def export_response(request: Request, kind, media_type, body):
+    start, end = parse_date_range(request)
+    changed_at = get_bookings_changed_at()
+    tag = hashlib.sha1(f"{kind}|{start}|{end}|{changed_at.isoformat()}".encode()).hexdigest()[:20]
+    # HTTP dates have one-second resolution; the ETag carries the exact marker
+    last_modified = changed_at.replace(microsecond=0)
+    headers = {
+        "ETag": f'"{tag}"',
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match:
+        if f'"{tag}"' in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since:
+        try:
+            if last_modified <= parsedate_to_datetime(if_modified_since):
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    return StreamingResponse(body(start, end, changed_at), media_type=media_type, headers=headers)
+
+
+# -----------------------------------------
+# BULK PATIENT IMPORT (CSV / JSONL, streamed)
+# -----------------------------------------
+IMPORT_LANGS = {
+    "fa": "fa", "farsi": "fa", "persian": "fa", "فارسی": "fa",
+    "en": "en", "english": "en",
+    "ar": "ar", "arabic": "ar", "العربية": "ar", "عربی": "ar",
+    "ru": "ru", "russian": "ru", "русский": "ru",
+}
+# chat_id is never imported: only register_user sets it, once the patient has verified
+# their own number with the bot
+PATIENT_UPSERT_SQL = (
+    "INSERT INTO patients (phone, name, whatsapp, lang, updated_at) VALUES (?,?,?,?,?) "
+    "ON CONFLICT (phone) DO UPDATE SET name=COALESCE(excluded.name, patients.name), "
+    "whatsapp=COALESCE(excluded.whatsapp, patients.whatsapp), lang=COALESCE(excluded.lang, patients.lang), "
+    "updated_at=excluded.updated_at"
+)
+
+
+def normalize_phone(raw):
+    # Returns "+<E.164 digits>" or None. Accepts Persian/Arabic digits, spaces, dashes,
+    # "00" international prefix and local "0..." numbers (DEFAULT_COUNTRY_CODE).
+    if raw is None:
+        return None
+    text = unicodedata.normalize("NFKC", str(raw)).translate(NORMALIZE_MAP).strip()
+    digits = re.sub(r"\D", "", text)
+    if text.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        if len(digits) - 1 < PHONE_MIN_NATIONAL_DIGITS:
+            return None
+        digits = DEFAULT_COUNTRY_CODE + digits[1:]
+    elif len(digits) <= 9:
+        if len(digits) < PHONE_MIN_NATIONAL_DIGITS:
+            return None
+        digits = DEFAULT_COUNTRY_CODE + digits
+    if not 8 <= len(digits) <= 15:
+        return None
+    return f"+{digits}"
+
+
+def clean_import_row(row):
+    # Returns the patient upsert params or raises ValueError with the reason
+    row = {str(k).strip().lower(): v for k, v in row.items() if k is not None}
+    phone = normalize_phone(row.get("phone"))
+    if not phone:
+        raise ValueError("missing phone" if not row.get("phone") else "invalid phone")
+    name = str(row.get("name") or "").strip() or None
+    whatsapp_raw = row.get("whatsapp")
+    whatsapp = normalize_phone(whatsapp_raw) if whatsapp_raw not in (None, "") else None
+    if whatsapp_raw not in (None, "") and not whatsapp:
+        raise ValueError("invalid whatsapp")
+    lang_raw = str(row.get("lang") or row.get("language") or "").strip().lower()
+    lang = IMPORT_LANGS.get(lang_raw)
+    if lang_raw and not lang:
+        raise ValueError("unknown language")
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    return (phone, name, whatsapp, lang, now)
+
+
+class QueueReader(io.RawIOBase):
+    # File-like view over byte chunks pushed by the request handler; None marks EOF
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b""
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.pending = chunk
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def iter_import_rows(chunks, fmt):
+    text = io.TextIOWrapper(io.BufferedReader(QueueReader(chunks)), encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        fields = [f.strip().lower() for f in reader.fieldnames or []]
+        if "phone" not in fields:
+            raise ValueError("CSV header must include a 'phone' column")
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            yield line_no, None
+            continue
+        yield line_no, row if isinstance(row, dict) else None
+
+
+def write_import_batch(conn, patients):
+    # One transaction per batch. New rows get rowids above the previous maximum, which
+    # tells inserts from updates without a SELECT per row.
+    before = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM patients").fetchone()[0]
+    conn.executemany(PATIENT_UPSERT_SQL, patients)
+    inserted = conn.execute("SELECT COUNT(*) FROM patients WHERE rowid > ?", (before,)).fetchone()[0]
+    conn.commit()
+    return inserted, len(patients) - inserted
+
+
+def import_patients(chunks, fmt):
+    # Runs on a worker thread so parsing and SQLite work never block the event loop
+    started = time.monotonic()
+    report = {"rows": 0, "inserted": 0, "updated": 0, "rejected": 0, "errors": []}
+    patients = []
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for line_no, row in iter_import_rows(chunks, fmt):
+            report["rows"] += 1
+            try:
+                if row is None:
+                    raise ValueError("invalid JSON object")
+                patient = clean_import_row(row)
+            except ValueError as e:
+                report["rejected"] += 1
+                if len(report["errors"]) < IMPORT_MAX_ERRORS_REPORTED:
+                    report["errors"].append({"line": line_no, "reason": str(e)})
+                continue
+            patients.append(patient)
+            if len(patients) >= IMPORT_BATCH_SIZE:
+                inserted, updated = write_import_batch(conn, patients)
+                report["inserted"] += inserted
+                report["updated"] += updated
+                patients = []
+        if patients:
+            inserted, updated = write_import_batch(conn, patients)
+            report["inserted"] += inserted
+            report["updated"] += updated
+    report["seconds"] = round(time.monotonic() - started, 2)
+    return report
+
+
 # -----------------------------------------
 # KEYBOARDS
 # -----------------------------------------
@@ -444,33 +1907,67 @@ def main_keyboard(lang):
         "resize_keyboard": True,
     }
 
-def doctors_keyboard(lang):
-    # Feature: Doctor selection buttons
-    any_txt = TRANS.get(lang, TRANS["en"])["any_doctor"]
-    return {
-        "keyboard": [
-            [{"text": "Dr. One"}, {"text": "Dr. Two"}],
-            [{"text": any_txt}],
-            [{"text": TRANS.get(lang, TRANS["en"])["cancel_button"]}]
-        ],
-        "resize_keyboard": True,
-    }
+# Inline keyboards for the booking flow. Callback data is "bk:<action>[:<arg>...]",
+# kept well under Telegram's 64-byte limit.
+def inline_rows(buttons, per_row=2):
+    return [buttons[i : i + per_row] for i in range(0, len(buttons), per_row)]
+
 
-def slots_keyboard(slots, lang):
+def services_inline_keyboard(lang):
     texts = TRANS.get(lang, TRANS["en"])
-    cancel_text = texts["cancel_button"]
-    kb = []
-    row = []
-    for s in slots:
-        # s format: "YYYY-MM-DD HH:MM" -> show "MM-DD HH:MM"
-        row.append({"text": s[5:]})
-        if len(row) == 2:
-            kb.append(row)
-            row = []
-    if row:
-        kb.append(row)
-    kb.append([{"text": cancel_text}])
-    return {"keyboard": kb, "resize_keyboard": True}
+    btns = [
+        {"text": labels.get(lang, labels["en"]), "callback_data": f"bk:srv:{code}"}
+        for code, labels in SERVICES.items()
+    ]
+    kb = inline_rows(btns)
+    kb.append([{"text": texts["cancel_button"], "callback_data": "bk:x"}])
+    return {"inline_keyboard": kb}
+
+
+def doctors_inline_keyboard(lang):
+    texts = TRANS.get(lang, TRANS["en"])
+    btns = [{"text": name, "callback_data": f"bk:doc:{code}"} for code, name in DOCTORS.items()]
+    kb = inline_rows(btns)
+    kb.append([{"text": texts["any_doctor"], "callback_data": "bk:doc:any"}])
+    kb.append([{"text": texts["cancel_button"], "callback_data": "bk:x"}])
+    return {"inline_keyboard": kb}
+
+
+def days_inline_keyboard(days, lang):
+    texts = TRANS.get(lang, TRANS["en"])
+    # day format: "YYYY-MM-DD" -> show "MM-DD (free slots)"
+    btns = [
+        {"text": f"{day[5:]} ({free})", "callback_data": f"bk:day:{day.replace('-', '')}"}
+        for day, free in days
+    ]
+    kb = inline_rows(btns, per_row=3)
+    kb.append([{"text": texts["cancel_button"], "callback_data": "bk:x"}])
+    return {"inline_keyboard": kb}
+
+
+def slots_inline_keyboard(day, slots, page, lang):
+    texts = TRANS.get(lang, TRANS["en"])
+    compact_day = day.replace("-", "")
+    has_next = len(slots) > SLOTS_PER_PAGE
+    btns = [
+        {"text": dt_str[11:], "callback_data": f"bk:slot:{slot_id}"}
+        for slot_id, dt_str in slots[:SLOTS_PER_PAGE]
+    ]
+    kb = inline_rows(btns)
+    nav = []
+    if page > 0:
+        nav.append({"text": "◀️", "callback_data": f"bk:day:{compact_day}:{page - 1}"})
+    if has_next:
+        nav.append({"text": "▶️", "callback_data": f"bk:day:{compact_day}:{page + 1}"})
+    if nav:
+        kb.append(nav)
+    kb.append(
+        [
+            {"text": texts["back_button"], "callback_data": "bk:days"},
+            {"text": texts["cancel_button"], "callback_data": "bk:x"},
+        ]
+    )
+    return {"inline_keyboard": kb}
 
 
 def get_all_menu_buttons():
@@ -481,12 +1978,292 @@ def get_all_menu_buttons():
     return set(all_btns)
 
 
+# -----------------------------------------
+# BOOKING FLOW (inline keyboard, edited in place)
+# -----------------------------------------
+async def start_booking(chat_id, lang, prefix=""):
+    texts = TRANS.get(lang, TRANS["en"])
+    # A fresh booking drops whatever an abandoned picker was still holding
+    release_holds(chat_id)
+    sent = await send_message(
+        chat_id, f"{prefix}{texts['booking_prompt']}", reply_markup=services_inline_keyboard(lang)
+    )
+    # The message id ties callbacks to this booking; taps on older messages are ignored
+    set_state(chat_id, "booking", "service", {"msg": sent.get("message_id") if sent else None})
+
+
+def hold_stats():
+    offered, attempts = HOLD_STATS["offered"], HOLD_STATS["book_attempts"]
+    return dict(
+        HOLD_STATS,
+        hold_conflict_rate=round(HOLD_STATS["hold_conflicts"] / offered, 3) if offered else None,
+        retry_rate=round(HOLD_STATS["book_conflicts"] / attempts, 3) if attempts else None,
+    )
+
+
+async def show_days(chat_id, message_id, state_data, lang):
+    texts = TRANS.get(lang, TRANS["en"])
+    # Counts exclude slots held for others; holds never cover a whole day, so no day vanishes
+    days = get_available_days(chat_id)
+    if not days:
+        clear_state(chat_id)
+        await edit_message_text(chat_id, message_id, texts["no_slots"])
+        return
+    set_state(chat_id, "booking", "day", state_data)
+    await edit_message_text(
+        chat_id, message_id, texts["day_prompt"], reply_markup=days_inline_keyboard(days, lang)
+    )
+
+
+async def show_slots(chat_id, message_id, state_data, lang, day, page, in_place=False):
+    texts = TRANS.get(lang, TRANS["en"])
+    offset = page * SLOTS_PER_PAGE
+    # Only slots book_slot_atomic will accept for this chat: free and not held for others
+    slots = get_available_slots(day, offset, chat_id=chat_id)
+    if not slots:
+        # Day filled up (or page emptied) while the user was looking
+        await show_days(chat_id, message_id, state_data, lang)
+        return
+    state_data["day"] = day
+    state_data["page"] = page
+    set_state(chat_id, "booking", "slot", state_data)
+    shown = [slot_id for slot_id, _ in slots[:SLOTS_PER_PAGE]]
+    acquired, conflicts = hold_slots(shown, chat_id, day)
+    HOLD_STATS["offered"] += len(shown)
+    HOLD_STATS["held"] += acquired
+    HOLD_STATS["hold_conflicts"] += conflicts
+    markup = slots_inline_keyboard(day, slots, page, lang)
+    if in_place:
+        # Same prompt, different page: only the buttons change
+        await edit_message_reply_markup(chat_id, message_id, markup)
+    else:
+        await edit_message_text(
+            chat_id, message_id, f"{texts['time_prompt']}\n🗓 {day}", reply_markup=markup
+        )
+
+
+async def handle_booking_callback(cq):
+    cq_id = cq.get("id")
+    message = cq.get("message") or {}
+    chat_id = message.get("chat", {}).get("id")
+    message_id = message.get("message_id")
+    parts = (cq.get("data") or "").split(":")
+    if not chat_id or parts[0] != "bk" or len(parts) < 2:
+        await answer_callback_query(cq_id)
+        return
+
+    user_row = get_user(chat_id)
+    if not user_row:
+        await answer_callback_query(cq_id, TRANS["en"]["type_start_to_register"])
+        return
+    user_name, lang = user_row[0], user_row[3]
+    texts = TRANS.get(lang, TRANS["en"])
+
+    state = get_state(chat_id)
+    if not state or state["flow_type"] != "booking" or state["data"].get("msg") != message_id:
+        # Stale picker (double tap after booking, or an older message): its text may be a
+        # confirmation that still stands, so only the buttons are removed
+        await answer_callback_query(cq_id)
+        await edit_message_reply_markup(chat_id, message_id, {"inline_keyboard": []})
+        return
+    data_state = state["data"]
+    action = parts[1]
+
+    if action == "x":
+        clear_state(chat_id)
+        release_holds(chat_id)
+        await answer_callback_query(cq_id)
+        await edit_message_text(chat_id, message_id, texts["cancelled"])
+        return
+
+    if action == "srv" and len(parts) == 3 and parts[2] in SERVICES:
+        data_state["service"] = parts[2]
+        set_state(chat_id, "booking", "doctor", data_state)
+        await answer_callback_query(cq_id)
+        await edit_message_text(
+            chat_id, message_id, texts["doctor_prompt"], reply_markup=doctors_inline_keyboard(lang)
+        )
+        return
+
+    if action == "doc" and len(parts) == 3 and (parts[2] in DOCTORS or parts[2] == "any"):
+        data_state["doctor"] = parts[2]
+        await answer_callback_query(cq_id)
+        await show_days(chat_id, message_id, data_state, lang)
+        return
+
+    if action == "days":
+        release_holds(chat_id)
+        await answer_callback_query(cq_id)
+        await show_days(chat_id, message_id, data_state, lang)
+        return
+
+    if action == "day" and len(parts) in (3, 4) and len(parts[2]) == 8 and parts[2].isdigit():
+        day = f"{parts[2][:4]}-{parts[2][4:6]}-{parts[2][6:]}"
+        page = int(parts[3]) if len(parts) == 4 and parts[3].isdigit() else 0
+        await answer_callback_query(cq_id)
+        await show_slots(
+            chat_id, message_id, data_state, lang, day, page, in_place=len(parts) == 4
+        )
+        return
+
+    if action == "slot" and len(parts) == 3 and parts[2].isdigit():
+        srv = SERVICES.get(data_state.get("service"), {}).get("en", "General")
+        doc = DOCTORS.get(data_state.get("doctor"), "Any")
+        booked_at = book_slot_atomic(int(parts[2]), chat_id, service=srv, doctor=doc)
+        HOLD_STATS["book_attempts"] += 1
+        if not booked_at:
+            HOLD_STATS["book_conflicts"] += 1
+            await answer_callback_query(cq_id, texts["slot_taken"])
+            day = data_state.get("day")
+            if day:
+                await show_slots(
+                    chat_id, message_id, data_state, lang, day, data_state.get("page", 0), in_place=True
+                )
+            else:
+                await show_days(chat_id, message_id, data_state, lang)
+            return
+
+        clear_state(chat_id)
+        schedule_reminders(int(parts[2]), booked_at, booked_ts=time.time())
+        await answer_callback_query(cq_id)
+        await edit_message_text(chat_id, message_id, f"{texts['booking_done']}\n🗓 {booked_at}")
+        if ADMIN_CHAT_ID:
+            try:
+                await send_message(
+                    int(ADMIN_CHAT_ID),
+                    f"📅 Booking:\nName: {user_name}\nWA: {user_row[1]}\nService: {srv}\nDr: {doc}\nTime: {booked_at}",
+                )
+            except Exception:
+                pass
+        return
+
+    await answer_callback_query(cq_id)
+
+
+# -----------------------------------------
+# REMINDER SCHEDULER (min-heap, rebuilt from the database on startup)
+# -----------------------------------------
+def parse_offsets(spec):
+    offsets = set()
+    for part in spec.split(","):
+        part = part.strip().lower()
+        if part.endswith("h") and part[:-1].isdigit():
+            offsets.add(int(part[:-1]) * 60)
+        elif part.endswith("m") and part[:-1].isdigit():
+            offsets.add(int(part[:-1]))
+        elif part:
+            log_event("config_invalid", logging.ERROR, var="REMINDER_OFFSETS", value=part)
+    return sorted(offsets, reverse=True)
+
+
+REMINDER_OFFSET_MINUTES = parse_offsets(REMINDER_OFFSETS)
+REMINDER_HEAP = []  # (due_ts, slot_id, offset_min)
+REMINDER_STATE = {"wake": None, "task": None}
+
+
+def appointment_ts(dt_str):
+    return datetime.strptime(dt_str, "%Y-%m-%d %H:%M").replace(tzinfo=DUBAI_TZ).timestamp()
+
+
+def schedule_reminders(slot_id, dt_str, booked_ts=None, already_sent=()):
+    # Offsets that were already due when the booking was made are skipped: a booking
+    # 20h ahead gets no "24h" reminder right after its confirmation
+    starts = appointment_ts(dt_str)
+    for offset in REMINDER_OFFSET_MINUTES:
+        due = starts - offset * 60
+        if booked_ts is not None and due < booked_ts:
+            continue
+        if (slot_id, offset) not in already_sent:
+            heapq.heappush(REMINDER_HEAP, (due, slot_id, offset))
+    if REMINDER_STATE["wake"]:
+        REMINDER_STATE["wake"].set()
+
+
+def rebuild_reminders():
+    bookings, sent = get_upcoming_bookings()
+    REMINDER_HEAP.clear()
+    for slot_id, dt_str, booked_at in bookings:
+        # Bookings from before booked_at was recorded get every offset
+        booked_ts = datetime.fromisoformat(booked_at).timestamp() if booked_at else None
+        schedule_reminders(slot_id, dt_str, booked_ts, sent)
+
+
+async def send_reminder(slot_id, offset):
+    target = get_reminder_target(slot_id)
+    if not target:
+        return False
+    dt_str, chat_id, name, lang = target
+    remaining = appointment_ts(dt_str) - time.time()
+    if remaining <= 0:
+        return False
+    # After downtime several reminders can be overdue at once; only the closest one is sent
+    if any(o < offset and remaining <= o * 60 for o in REMINDER_OFFSET_MINUTES):
+        mark_reminder_as_sent(slot_id, offset)
+        return False
+    if not mark_reminder_as_sent(slot_id, offset):
+        return False
+
+    texts = TRANS.get(lang, TRANS["en"])
+    date_part, time_part = dt_str.split(" ")
+    today = datetime.now(DUBAI_TZ).date()
+    appt_day = datetime.strptime(date_part, "%Y-%m-%d").date()
+    if appt_day == today:
+        key = "reminder_today_msg"
+    elif appt_day == today + timedelta(days=1):
+        key = "reminder_msg"
+    else:
+        key = "reminder_date_msg"
+    msg = f"⏰ {texts[key].format(name=name, date=date_part, time=time_part)}"
+    await send_message(chat_id, msg)
+    log_event("reminder_sent", chat_id=chat_id, slot_id=slot_id, offset_min=offset)
+    return True
+
+
+async def process_due_reminders():
+    sent = 0
+    while REMINDER_HEAP and REMINDER_HEAP[0][0] <= time.time():
+        _, slot_id, offset = heapq.heappop(REMINDER_HEAP)
+        if await send_reminder(slot_id, offset):
+            sent += 1
+    return sent
+
+
+async def reminder_loop():
+    wake = REMINDER_STATE["wake"]
+    while True:
+        wake.clear()
+        try:
+            await process_due_reminders()
+        except Exception:
+            log_event("reminder_failed", logging.ERROR, exc_info=True)
+        # Sleep until the next reminder is due, or until a new booking wakes us
+        timeout = REMINDER_MAX_SLEEP
+        if REMINDER_HEAP:
+            timeout = min(max(REMINDER_HEAP[0][0] - time.time(), 0), REMINDER_MAX_SLEEP)
+        # asyncio.wait rather than wait_for: wait_for can swallow a shutdown cancel
+        # that lands just as the event fires
+        waiter = asyncio.ensure_future(wake.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            waiter.cancel()
+
+
 # -----------------------------------------
 # ROUTES
 # -----------------------------------------
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     init_db()
+    rebuild_reminders()
+    REMINDER_STATE["wake"] = asyncio.Event()
+    REMINDER_STATE["task"] = asyncio.create_task(reminder_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if REMINDER_STATE["task"]:
+        REMINDER_STATE["task"].cancel()
 
 
 @app.get("/")
@@ -494,28 +2271,158 @@ async def root():
     return {"status": "ok", "message": "Dental Bot V12 (Fixed AI & Features)"}
 
 
+def require_admin(request: Request):
+    token = request.headers.get("x-admin-token") or ""
+    if not ADMIN_API_TOKEN or not secrets.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/stats")
+async def admin_stats(request: Request, days: int = 30):
+    require_admin(request)
+    return dict(get_stats(max(1, min(days, 365))), slot_holds=hold_stats())
+
+
+@app.get("/admin/ai")
+async def admin_ai(request: Request):
+    require_admin(request)
+    return dict(ai_health(), intents=intent_stats())
+
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, interval_ms: float = 5, all_threads: bool = False):
+    # Samples the event-loop thread (or every thread) and returns folded stacks,
+    # ready for flamegraph.pl or speedscope. The loop keeps serving while sampling.
+    require_admin(request)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    interval = max(0.001, interval_ms / 1000)
+    if not PROFILE_LOCK.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        thread_ids = None if all_threads else {threading.get_ident()}
+        counts = await asyncio.to_thread(sample_stacks, thread_ids, seconds, interval)
+    finally:
+        PROFILE_LOCK.release()
+    log_event("profile_taken", seconds=seconds, samples=sum(counts.values()))
+    body = "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+    return PlainTextResponse(body)
+
+
+@app.post("/admin/import")
+async def admin_import(request: Request, format: str = None):
+    # Body is read chunk by chunk and handed to a worker thread through a bounded queue,
+    # so memory stays flat and the event loop keeps serving webhooks meanwhile
+    require_admin(request)
+    fmt = (format or ("jsonl" if "json" in request.headers.get("content-type", "") else "csv")).lower()
+    if fmt not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="format must be csv or jsonl")
+
+    chunks = queue.Queue(maxsize=64)
+    job = asyncio.ensure_future(asyncio.to_thread(import_patients, chunks, fmt))
+
+    async def feed(chunk):
+        # The worker may stop early (bad header); never block on a queue nobody reads
+        while not job.done():
+            try:
+                chunks.put_nowait(chunk)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.005)
+
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await feed(chunk)
+    finally:
+        await feed(None)
+    try:
+        report = await job
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Upload must be UTF-8")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    log_event("patients_imported", **{k: v for k, v in report.items() if k != "errors"})
+    return report
+
+
+@app.get("/admin/export.csv")
+async def admin_export_csv(request: Request):
+    require_admin(request)
+    return export_response(
+        request,
+        "csv",
+        "text/csv; charset=utf-8",
+        lambda start, end, changed_at: csv_chunks(start, end),
+    )
+
+
+@app.get("/admin/calendar.ics")
+async def admin_calendar_ics(request: Request):
+    require_admin(request)
+    return export_response(request, "ics", "text/calendar; charset=utf-8", ics_chunks)
+
+
+@app.get("/admin/calendar/{token}.ics")
+async def admin_calendar_feed(request: Request, token: str):
+    # Subscription URL for Google/Apple/Outlook calendars
+    if not CALENDAR_FEED_TOKEN or not secrets.compare_digest(token.encode(), CALENDAR_FEED_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return export_response(request, "ics", "text/calendar; charset=utf-8", ics_chunks)
+
+
 @app.get("/trigger-reminders")
 async def trigger_reminders():
-    reminders = get_pending_reminders()
-    count = 0
-    for slot_id, dt_str, chat_id, name, lang in reminders:
-        texts = TRANS.get(lang, TRANS["en"])
-        date_part = dt_str.split(" ")[0]
-        time_part = dt_str.split(" ")[1]
-        msg = f"⏰ {texts['reminder_msg'].format(name=name, date=date_part, time=time_part)}"
-        await send_message(chat_id, msg)
-        mark_reminder_as_sent(slot_id)
-        count += 1
-    return {"status": "success", "sent": count}
+    # Kept for existing cron jobs; the in-process scheduler normally sends these on time
+    rebuild_reminders()
+    count = await process_due_reminders()
+    return {"status": "success", "sent": count, "pending": len(REMINDER_HEAP)}
 
 
 @app.post("/webhook")
 async def webhook(request: Request):
+    started = time.monotonic()
     try:
         data = await request.json()
     except Exception:
         return {"ok": True}
 
+    source = data.get("message") or (data.get("callback_query") or {}).get("message") or {}
+    ctx_token = LOG_CTX.set(
+        {
+            "update_id": data.get("update_id"),
+            "chat_id": source.get("chat", {}).get("id"),
+            "branch": None,
+        }
+    )
+    root = None
+    try:
+        with span("update", root=True) as root:
+            try:
+                return await handle_update(data)
+            finally:
+                root.attrs.update(LOG_CTX.get())
+    except Exception:
+        log_event("update_failed", logging.ERROR, exc_info=True)
+        raise
+    finally:
+        duration_ms = round((time.monotonic() - started) * 1000, 1)
+        log_event(
+            "update_handled",
+            sample=LOG_UPDATE_SAMPLE_RATE,
+            keep=duration_ms >= LOG_SLOW_UPDATE_MS,
+            duration_ms=duration_ms,
+            spans_ms=root.trace["ms"] if root else None,
+            trace_id=root.trace["id"] if root else None,
+        )
+        LOG_CTX.reset(ctx_token)
+
+
+async def handle_update(data):
+    if data.get("callback_query"):
+        set_log_context(branch="booking_callback")
+        await handle_booking_callback(data["callback_query"])
+        return {"ok": True}
+
     msg = data.get("message", {})
     chat_id = msg.get("chat", {}).get("id")
     text = (msg.get("text") or "").strip()
@@ -525,6 +2432,7 @@ async def webhook(request: Request):
 
     # Admin broadcast
     if str(chat_id) == str(ADMIN_CHAT_ID) and text.startswith("/broadcast"):
+        set_log_context(branch="broadcast")
         body = text.replace("/broadcast", "").strip()
         users = get_all_users()
         for u in users:
@@ -534,19 +2442,8 @@ async def webhook(request: Request):
         return {"ok": True}
 
     # Load state
-    with sqlite3.connect(DB_NAME) as conn:
-        state_row = conn.execute(
-            "SELECT flow_type, step, data FROM states WHERE chat_id=?", (chat_id,)
-        ).fetchone()
-        current_state = (
-            {
-                "flow_type": state_row[0],
-                "step": state_row[1],
-                "data": json.loads(state_row[2]) if state_row[2] else {},
-            }
-            if state_row
-            else None
-        )
+    saved_state = get_state(chat_id)
+    current_state = saved_state
 
     user_row = get_user(chat_id)
     user_name = user_row[0] if user_row else None
@@ -556,22 +2453,16 @@ async def webhook(request: Request):
     # Global interceptor: reset state if user pressed any main menu button
     all_menu_btns = get_all_menu_buttons()
     if text in all_menu_btns:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-            conn.commit()
+        clear_state(chat_id)
+        release_holds(chat_id)
         current_state = None
 
     # Image (teledentistry)
     if msg.get("photo"):
+        set_log_context(branch="photo")
         if not user_row:
             # Try to infer language from state if available
-            guessed_lang = "en"
-            if state_row and state_row[2]:
-                try:
-                    sd = json.loads(state_row[2])
-                    guessed_lang = sd.get("lang", "en")
-                except Exception:
-                    pass
+            guessed_lang = saved_state["data"].get("lang", "en") if saved_state else "en"
             t = TRANS.get(guessed_lang, TRANS["en"])
             await send_message(chat_id, t["please_register_first"])
             return {"ok": True}
@@ -598,6 +2489,7 @@ async def webhook(request: Request):
 
     # Contact verification during registration
     if current_state and current_state["step"] == "phone":
+        set_log_context(branch="reg_phone")
         data_state = current_state["data"]
         state_lang = data_state.get("lang", "en")
         state_texts = TRANS.get(state_lang, TRANS["en"])
@@ -612,16 +2504,14 @@ async def webhook(request: Request):
                 )
                 return {"ok": True}
 
-            upsert_user(
+            register_user(
                 chat_id,
                 name=data_state.get("name"),
                 whatsapp=data_state.get("whatsapp"),
                 phone=contact.get("phone_number"),
                 lang=state_lang,
             )
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                conn.commit()
+            clear_state(chat_id)
 
             welcome_msg = state_texts["reg_complete"]
             await send_message(
@@ -637,13 +2527,9 @@ async def webhook(request: Request):
 
     # /start command
     if text == "/start":
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-            conn.execute(
-                "INSERT INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
-                (chat_id, "reg", "lang", "{}"),
-            )
-            conn.commit()
+        set_log_context(branch="start")
+        set_state(chat_id, "reg", "lang", {})
+        release_holds(chat_id)
 
         start_msg = (
             "Please select language:\n"
@@ -658,6 +2544,7 @@ async def webhook(request: Request):
     # Registration flow
     if current_state and current_state["flow_type"] == "reg":
         step = current_state["step"]
+        set_log_context(branch=f"reg_{step}")
         data_state = current_state["data"]
 
         if step == "lang":
@@ -684,12 +2571,7 @@ async def webhook(request: Request):
                 return {"ok": True}
 
             upsert_user(chat_id, lang=sel_lang)
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("name", json.dumps({"lang": sel_lang}), chat_id),
-                )
-                conn.commit()
+            set_state(chat_id, "reg", "name", {"lang": sel_lang})
 
             await send_message(
                 chat_id,
@@ -709,23 +2591,13 @@ async def webhook(request: Request):
                 return {"ok": True}
 
             data_state["name"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("whatsapp", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
+            set_state(chat_id, "reg", "whatsapp", data_state)
             await send_message(chat_id, TRANS[data_state["lang"]]["whatsapp_prompt"])
             return {"ok": True}
 
         if step == "whatsapp":
             data_state["whatsapp"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("phone", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
+            set_state(chat_id, "reg", "phone", data_state)
             await send_message(
                 chat_id,
                 TRANS[data_state["lang"]]["phone_prompt"],
@@ -735,107 +2607,31 @@ async def webhook(request: Request):
 
     # If user not registered at this point
     if not user_row:
+        set_log_context(branch="unregistered")
         # We may not know language yet, so use English text
         base_texts = TRANS["en"]
         await send_message(chat_id, base_texts["type_start_to_register"])
         return {"ok": True}
 
-    # Booking flow
+    # Booking flow runs on inline buttons (see handle_booking_callback); typed text here
+    # is either a cancel or a stray message while the picker is open
     if current_state and current_state["flow_type"] == "booking":
-        step = current_state["step"]
-        data_state = current_state["data"]
-
-        # Cancel booking
+        set_log_context(branch="booking_text")
         if text.strip().lower() == texts["cancel_button"].strip().lower():
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                conn.commit()
+            clear_state(chat_id)
+            release_holds(chat_id)
             await send_message(
                 chat_id, texts["cancelled"], reply_markup=main_keyboard(lang)
             )
-            return {"ok": True}
-
-        if step == "service":
-            data_state["service"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("doctor", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
-            # Feature: Show Doctor buttons here
-            await send_message(
-                chat_id, 
-                texts["doctor_prompt"],
-                reply_markup=doctors_keyboard(lang)
-            )
-            return {"ok": True}
-
-        if step == "doctor":
-            data_state["doctor"] = text
-            slots = get_available_slots()
-            if not slots:
-                with sqlite3.connect(DB_NAME) as conn:
-                    conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                    conn.commit()
-                await send_message(
-                    chat_id, texts["no_slots"], reply_markup=main_keyboard(lang)
-                )
-                return {"ok": True}
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("slot", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
-            await send_message(
-                chat_id,
-                texts["time_prompt"],
-                reply_markup=slots_keyboard(slots, lang),
-            )
-            return {"ok": True}
-
-        if step == "slot":
-            clicked_slot = text.strip()
-            full_slot = None
-            with sqlite3.connect(DB_NAME) as conn:
-                found = conn.execute(
-                    "SELECT datetime_str FROM slots WHERE datetime_str LIKE ? AND is_booked=0",
-                    (f"%{clicked_slot}",),
-                ).fetchone()
-                if found:
-                    full_slot = found[0]
-
-            if full_slot and book_slot_atomic(full_slot, chat_id):
-                with sqlite3.connect(DB_NAME) as conn:
-                    conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                    conn.commit()
-                await send_message(
-                    chat_id, texts["booking_done"], reply_markup=main_keyboard(lang)
-                )
-                if ADMIN_CHAT_ID:
-                    try:
-                        doc = data_state.get("doctor", "Any")
-                        srv = data_state.get("service", "General")
-                        await send_message(
-                            int(ADMIN_CHAT_ID),
-                            f"📅 Booking:\nName: {user_name}\nWA: {user_row[1]}\nService: {srv}\nDr: {doc}\nTime: {full_slot}",
-                        )
-                    except Exception:
-                        pass
-            else:
-                new_slots = get_available_slots()
-                await send_message(
-                    chat_id,
-                    texts["slot_taken"],
-                    reply_markup=slots_keyboard(new_slots, lang),
-                )
-            return {"ok": True}
+        else:
+            await send_message(chat_id, texts["select_from_buttons"])
+        return {"ok": True}
 
     # Main menu handling
     flat_btns = [b for r in texts["buttons"] for b in r]
     if text in flat_btns:
         idx = flat_btns.index(text)
+        set_log_context(branch=f"menu_{idx}")
         prefix = texts["greeting"].format(name=user_name)
         if idx == 0:
             await send_message(
@@ -850,13 +2646,7 @@ async def webhook(request: Request):
                 reply_markup=main_keyboard(lang),
             )
         elif idx == 2:
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "INSERT OR REPLACE INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
-                    (chat_id, "booking", "service", "{}"),
-                )
-                conn.commit()
-            await send_message(chat_id, f"{prefix}{texts['booking_prompt']}")
+            await start_booking(chat_id, lang, prefix)
         elif idx == 3:
             # Feature: Address with Link
             await send_message(
@@ -870,7 +2660,25 @@ async def webhook(request: Request):
             )
         return {"ok": True}
 
+    # Common FAQs answered locally; only low-confidence text goes to Gemini
+    intent = match_intent(text, lang)
+    if intent:
+        set_log_context(branch=f"intent_{intent}")
+        prefix = texts["greeting"].format(name=user_name)
+        if intent == "booking":
+            await start_booking(chat_id, lang, prefix)
+        elif intent == "address":
+            await send_message(chat_id, texts["address_reply"], reply_markup=main_keyboard(lang))
+        else:
+            await send_message(
+                chat_id,
+                f"{prefix}\n{texts[INTENT_REPLY_KEYS[intent]]}",
+                reply_markup=main_keyboard(lang),
+            )
+        return {"ok": True}
+
     # AI chat fallback
+    set_log_context(branch="ai_text")
     gemini_ans = await ask_gemini_text(text, lang)
     prefix = texts["greeting"].format(name=user_name)
     await send_message(
@@ -0,0 +1,11 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # Fresh database per test; init_db seeds a week of slots starting tomorrow
+    monkeypatch.setattr(app, "DB_NAME", str(tmp_path / "dental_bot.db"))
+    app.init_db()
+    return app.DB_NAME
@@ -0,0 +1,87 @@
+import queue
+import sqlite3
+
+import pytest
+
+import app
+from app import import_patients, normalize_phone
+
+
+@pytest.fixture(autouse=True)
+def uae_numbers(monkeypatch):
+    monkeypatch.setattr(app, "DEFAULT_COUNTRY_CODE", "971")
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("+971501234567", "+971501234567"),
+        ("+44 20 7946 0958", "+442079460958"),
+        ("00971501234567", "+971501234567"),
+        ("0501234567", "+971501234567"),
+        ("050-123 4567", "+971501234567"),
+        ("۰۵۰۱۲۳۴۵۶۷", "+971501234567"),  # Persian digits
+        ("٠٥٠١٢٣٤٥٦٧", "+971501234567"),  # Arabic-Indic digits
+        ("501234567", "+971501234567"),  # 9-digit local, no trunk 0
+        ("4123456", "+9714123456"),  # shortest accepted local number
+        ("123456", None),  # too short to be a local number
+        ("12345", None),
+        ("012345", None),
+        ("+1234567", None),  # under 8 digits in total
+        ("+1234567890123456", None),  # over 15 digits
+        ("", None),
+        (None, None),
+    ],
+)
+def test_normalize_phone(raw, expected):
+    assert normalize_phone(raw) == expected
+
+
+def run_import(body, fmt):
+    chunks = queue.Queue()
+    data = body.encode("utf-8")
+    for i in range(0, len(data), 7):  # small chunks: rows span chunk boundaries
+        chunks.put(data[i : i + 7])
+    chunks.put(None)
+    return import_patients(chunks, fmt)
+
+
+def patients():
+    with sqlite3.connect(app.DB_NAME) as conn:
+        return dict(conn.execute("SELECT phone, name FROM patients").fetchall())
+
+
+def test_csv_import_counts(db):
+    report = run_import(
+        "phone,name,lang\n0501234567,Ali,fa\n12345,Bad,\n0509999999,Sara,english\n,NoPhone,\n",
+        "csv",
+    )
+    assert (report["rows"], report["inserted"], report["updated"], report["rejected"]) == (4, 2, 0, 2)
+    assert [e["reason"] for e in report["errors"]] == ["invalid phone", "missing phone"]
+
+    report = run_import("phone,name\n+971501234567,Ali Rezaei\n0551112222,New\n", "csv")
+    assert (report["inserted"], report["updated"], report["rejected"]) == (1, 1, 0)
+    assert patients()["+971501234567"] == "Ali Rezaei"
+
+
+def test_jsonl_import_counts(db):
+    body = (
+        '{"phone": "0501234567", "name": "Ali"}\n'
+        "\n"
+        "not json\n"
+        '["a list"]\n'
+        '{"phone": "0501234567", "language": "klingon"}\n'
+        '{"phone": "00971509999999", "name": "Sara"}\n'
+    )
+    report = run_import(body, "jsonl")
+    assert (report["rows"], report["inserted"], report["updated"], report["rejected"]) == (5, 2, 0, 3)
+    assert [e["reason"] for e in report["errors"]] == [
+        "invalid JSON object",
+        "invalid JSON object",
+        "unknown language",
+    ]
+
+
+def test_csv_without_phone_header_is_refused(db):
+    with pytest.raises(ValueError, match="phone"):
+        run_import("name,whatsapp\nAli,0501234567\n", "csv")
@@ -0,0 +1,55 @@
+import pytest
+
+from app import match_intent
+
+
+@pytest.mark.parametrize(
+    "text, lang, expected",
+    [
+        ("what are your working hours?", "en", "hours"),
+        ("where are you located", "en", "address"),
+        ("I want to book an appointment", "en", "booking"),
+        ("ساعات کاری", "fa", "hours"),
+        ("رزرو نوبت", "fa", "booking"),
+        ("حجز موعد", "ar", "booking"),
+        ("хочу записаться", "ru", "booking"),
+        ("what is your address?", "en", "address"),
+        ("what services do you have", "en", "services"),
+        ("آدرس کلینیک کجاست", "fa", "address"),
+        ("ما هي الخدمات", "ar", "services"),
+        ("какие услуги у вас есть", "ru", "services"),
+    ],
+)
+def test_common_questions_match(text, lang, expected):
+    assert match_intent(text, lang) == expected
+
+
+@pytest.mark.parametrize(
+    "text, lang",
+    [
+        # Bare keywords alone are not enough
+        ("booking", "en"),
+        ("запись", "ru"),
+        ("where are you from?", "en"),
+        ("what is the price of services", "en"),
+        ("do you offer whitening services for kids?", "en"),
+        ("Do you have an email address?", "en"),
+        ("где вы учились", "ru"),
+        ("خدمات", "fa"),
+        ("آدرس", "fa"),
+        ("العنوان", "ar"),
+        ("الخدمات", "ar"),
+        ("адрес", "ru"),
+        ("услуги", "ru"),
+        # Negative cues: these are about an existing booking or something else entirely
+        ("I want to cancel my booking", "en"),
+        ("can I change my appointment booking?", "en"),
+        ("is parking available near your location?", "en"),
+        ("отменить запись", "ru"),
+        ("перенести запись на завтра", "ru"),
+        ("لغو رزرو نوبت", "fa"),
+        ("إلغاء حجز موعد", "ar"),
+    ],
+)
+def test_ambiguous_or_negated_text_goes_to_gemini(text, lang):
+    assert match_intent(text, lang) is None
@@ -0,0 +1,63 @@
+import sqlite3
+
+import app
+from app import book_slot_atomic, get_available_days, get_available_slots, hold_slots
+
+
+def first_day():
+    return get_available_days()[0][0]
+
+
+def offer(chat_id, day):
+    # What show_slots does: list the slots this chat may book, then hold some of them
+    shown = [slot_id for slot_id, _ in get_available_slots(day, chat_id=chat_id)]
+    acquired, _ = hold_slots(shown, chat_id, day)
+    return shown, acquired
+
+
+def held_by(chat_id):
+    with sqlite3.connect(app.DB_NAME) as conn:
+        return {r[0] for r in conn.execute("SELECT slot_id FROM slot_holds WHERE chat_id=?", (chat_id,))}
+
+
+def test_concurrent_bookers_get_disjoint_holds_and_never_the_last_slot(db):
+    day = first_day()
+    free = len(get_available_slots(day, limit=100))
+    assert free == 6
+
+    acquired = [offer(chat_id, day)[1] for chat_id in (1, 2, 3, 4)]
+    assert acquired == [2, 2, 1, 0]
+    holds = [held_by(chat_id) for chat_id in (1, 2, 3, 4)]
+    assert sum(len(h) for h in holds) == len(set().union(*holds)) == 5
+
+    # The day stays bookable for everyone: one free slot is left unheld
+    shown, _ = offer(5, day)
+    assert len(shown) == 1
+    assert not set(shown) & set().union(*holds)
+
+
+def test_re_offering_replaces_own_holds(db):
+    day = first_day()
+    offer(1, day)
+    offer(1, day)
+    assert len(held_by(1)) == app.SLOT_HOLDS_PER_BOOKER
+
+
+def test_booking_refused_for_slots_held_by_others(db):
+    day = first_day()
+    offer(1, day)
+    slot_id = min(held_by(1))
+    assert slot_id not in [s for s, _ in get_available_slots(day, chat_id=2)]
+    assert book_slot_atomic(slot_id, 2) is None
+    assert book_slot_atomic(slot_id, 1) is not None
+    # Booking drops the booker's remaining holds
+    assert held_by(1) == set()
+
+
+def test_expired_holds_are_ignored(db):
+    day = first_day()
+    shown = [slot_id for slot_id, _ in get_available_slots(day, chat_id=1)]
+    hold_slots(shown, 1, day, ttl=0)
+    slot_id = shown[0]
+    assert slot_id in [s for s, _ in get_available_slots(day, chat_id=2)]
+    assert book_slot_atomic(slot_id, 2) is not None